@@ -2,162 +2,2150 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import pandas as pd
+import bisect
+import collections
+import contextlib
+import csv
+import enum
+import gzip
+import itertools
+import json
+import numpy as np
+import os
 import re
-import warnings
+import struct
+import zlib
+
+# CIGAR operations, numbered by their code in the SAM/BAM specification
+_CIGAR_OPS = 'MIDNSHP=X'
+_CIGAR_OP_CODES = {op: code for code, op in enumerate(_CIGAR_OPS)}
+
+# CIGAR operations that advance along the transcript (the query, in SAM terms) and along the genome (the reference),
+# respectively. Hard-clipped bases are missing from SEQ but are still part of the transcript, so hard clips (H) advance
+# along the transcript like soft clips; padding (P) advances along neither.
+_TX_CONSUMING_OPS = frozenset('MISH=X')
+_GENOME_CONSUMING_OPS = frozenset('MDN=X')
+
+# Direction along the genome in which transcripts on each strand run
+_STRAND_DIRECTIONS = {'+': 1, '-': -1}
+
+# Lookup tables indexed by CIGAR op code
+_CONSUMES_TX = np.array([op in _TX_CONSUMING_OPS for op in _CIGAR_OPS])
+_CONSUMES_GENOME = np.array([op in _GENOME_CONSUMING_OPS for op in _CIGAR_OPS])
+
+# Single-pass CIGAR tokenizer, and the byte -> op code table used by the bulk tokenizer (255 for bytes that are not
+# valid CIGAR ops)
+_CIGAR_TOKEN_RE = re.compile(r'(\d+)([MIDNSHP=X])')
+_CIGAR_BYTE_OP_CODES = np.full(256, 255, dtype=np.uint8)
+for _op in _CIGAR_OPS:
+    _CIGAR_BYTE_OP_CODES[ord(_op)] = _CIGAR_OP_CODES[_op]
+
+# File name extensions of GTF and GFF3 annotation files, and the attribute holding the transcript ID(s) of an exon:
+# transcript_id in GTF, or Parent, possibly listing several comma-separated IDs, in GFF3
+_ANNOTATION_EXTENSIONS = ('.gtf', '.gff', '.gff3')
+_ANNOTATION_TX_ID_RE = re.compile(r'transcript_id "([^"]*)"|(?:^|;)\s*Parent=([^;]*)')
+
+# SAM FLAG bits: reverse strand, and the records skipped by default, i.e. unmapped, secondary, QC-failed and
+# supplementary alignments. Secondary and supplementary alignments that are not skipped are added after all others, so
+# the primary alignment of each transcript is its first one
+_SAM_FLAG_REVERSE = 0x10
+_SAM_FLAG_NOT_PRIMARY = 0x100 | 0x800
+_SAM_EXCLUDE_FLAGS = 0x4 | 0x100 | 0x200 | 0x800
+
+# Default number of query lines read, mapped and written together by run()
+_QUERY_CHUNK_SIZE = 100_000
+
+# Token inserted at the start of each line of a block of queries split in bulk, to check the number of fields per line
+_QUERY_LINE_MARKER = '\0'
+
+# Default number of bytes of formatted output buffered by a ResultWriter before writing
+_WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Maximum number of candidate blocks expanded at a time by GenomeIntervalIndex.query_many, which bounds its memory use
+_INTERVAL_CANDIDATE_LIMIT = 1 << 22
+
+# Input files starting with the gzip magic bytes, which include BGZF files, are decompressed while reading. Compressed
+# output is written as BGZF, in blocks of at most _BGZF_BLOCK_SIZE uncompressed bytes (as in htslib, so that every
+# compressed block fits in 64 KiB), followed by the BGZF end-of-file marker block
+_GZIP_MAGIC = b'\x1f\x8b'
+_COMPRESSED_EXTENSIONS = ('.gz', '.bgz')
+_BGZF_BLOCK_SIZE = 0xff00
+_BGZF_HEADER = struct.Struct('<4BI2BH2BHH')
+_BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# Magic bytes at the start of Parquet files and Arrow IPC (Feather v2) files, which are read with pyarrow, and the
+# formats results can be written in
+_PARQUET_MAGIC = b'PAR1'
+_ARROW_MAGIC = b'ARROW1'
+_OUTPUT_FORMATS = ('tsv', 'parquet', 'arrow')
+
+# Default number of distinct parsed CIGAR strings kept by a CIGARCache
+_CIGAR_CACHE_SIZE = 100_000
+
+# Binary index files written by SegmentTable.save start with the magic bytes, followed by the little-endian format
+# version (uint32) and header length (uint64), the JSON header, and the arrays, each aligned to _INDEX_ALIGNMENT bytes
+_INDEX_MAGIC = b'TXMAPIDX'
+_INDEX_VERSION = 5
+_INDEX_PREAMBLE = struct.Struct('<IQ')
+_INDEX_ALIGNMENT = 64
+
+
+class MappingStatus(enum.IntEnum):
+    """ Outcome of mapping a single coordinate, as reported by the batch and genome -> transcript mapping methods """
+    OK = 0
+    IN_INSERTION = 1        # coordinate in an insertion or clip, the next genomic coordinate is used
+    OUT_OF_BOUNDS = 2       # coordinate outside the transcript (or its alignment), no coordinate is reported
+    UNKNOWN_TX = 3          # transcript ID not found in the transcript mappings
+    IN_DELETION = 4         # genomic coordinate in a deletion or intron, the next transcript coordinate is used
+
+
+# Names of the MappingStatus codes, indexed by code, as written to the status output column, and the chromosome ID
+# written for queries on unknown transcripts
+_STATUS_NAMES = np.array([status.name for status in MappingStatus], dtype=object)
+_UNMAPPED_CHROM_ID = '*'
+
+
+# Block of a transcript interval mapped to the genome, as returned by CIGARString.map_interval. Blocks that fall in an
+# insertion or clip have status MappingStatus.IN_INSERTION and an empty genomic interval at the base to the right
+# of it.
+MappedBlock = collections.namedtuple('MappedBlock', ['tx_start', 'tx_end', 'chrom_start', 'chrom_end', 'status'])
+
+
+def parse_cigar_strings(cigar_strs) -> (np.ndarray, np.ndarray, np.ndarray):
+    """ Parse a whole column of CIGAR strings at once, working on the concatenated bytes of all strings with NumPy.
+    Regions of all strings are returned in compact arrays, with the regions of string i found at
+    [row_offsets[i], row_offsets[i + 1]). For example, ['8M7D', '2I'] returns lengths [8, 7, 2], op codes [0, 2, 1] and
+    row offsets [0, 2, 3].
+
+    :param cigar_strs: sequence of CIGAR strings
+    :return tuple of int64 region lengths, uint8 region op codes (indexing _CIGAR_OPS), and int64 row offsets
+    :raises ValueError: if any of the strings is not a valid CIGAR string
+    """
+    for row_ix, cigar_str in enumerate(cigar_strs):
+        if not cigar_str.isascii():
+            raise ValueError(f"Invalid CIGAR string (row = {row_ix}, CIGAR str = {cigar_str})")
+    str_lengths = np.fromiter((len(s) for s in cigar_strs), dtype=np.int64, count=len(cigar_strs))
+    str_ends = np.cumsum(str_lengths)
+    buf = np.frombuffer(''.join(cigar_strs).encode('ascii'), dtype=np.uint8)
+
+    is_digit = (buf >= ord('0')) & (buf <= ord('9'))
+    op_pos = np.flatnonzero(~is_digit)
+
+    # Every byte must be a digit or a valid op, every op must follow a digit, and every string must end in an op
+    follows_digit = (op_pos > 0) & is_digit[np.maximum(op_pos - 1, 0)]
+    invalid_ops = (_CIGAR_BYTE_OP_CODES[buf[op_pos]] == 255) | ~follows_digit
+    invalid_strs = str_lengths == 0
+    invalid_strs[~invalid_strs] = is_digit[str_ends[~invalid_strs] - 1]
+    if invalid_ops.any() or invalid_strs.any():
+        bad_rows = np.concatenate([np.searchsorted(str_ends, op_pos[invalid_ops], side='right'),
+                                   np.flatnonzero(invalid_strs)])
+        row_ix = bad_rows.min()
+        raise ValueError(f"Invalid CIGAR string (row = {row_ix}, CIGAR str = {cigar_strs[row_ix]})")
+
+    # Each region length is the sum of its digits times powers of ten, counted back from the op that ends it
+    digit_pos = np.flatnonzero(is_digit)
+    digit_region = np.searchsorted(op_pos, digit_pos)
+    exponents = op_pos[digit_region] - digit_pos - 1
+    if len(exponents) and exponents.max() > 17:
+        raise ValueError("Invalid CIGAR string, region length does not fit in 64 bits")
+    digit_values = (buf[digit_pos] - ord('0')).astype(np.int64) * (10 ** exponents)
+    region_first_digits = np.searchsorted(digit_region, np.arange(len(op_pos)))
+    lengths = np.add.reduceat(digit_values, region_first_digits) if len(op_pos) else np.zeros(0, dtype=np.int64)
+
+    ops = _CIGAR_BYTE_OP_CODES[buf[op_pos]]
+    row_offsets = np.zeros(len(cigar_strs) + 1, dtype=np.int64)
+    row_offsets[1:] = np.searchsorted(op_pos, str_ends)
+    return lengths, ops, row_offsets
+
+
+def exon_model_regions(exon_starts, exon_ends, row_offsets) -> (np.ndarray, np.ndarray, np.ndarray):
+    """ Build the CIGAR regions of a whole column of exon models at once, in the form returned by parse_cigar_strings:
+    exons become M regions, and the gaps between them N (intron) regions. The exons of model i are those at
+    [row_offsets[i], row_offsets[i + 1]) in exon_starts and exon_ends, sorted by start, and every model has at least one
+    exon. For example, the exons [0, 10), [15, 20) and [30, 32) return lengths [10, 5, 5, 10, 2], op codes
+    [0, 3, 0, 3, 0] and row offsets [0, 5], i.e. the regions of '10M5N5M10N2M'.
+
+    :param exon_starts: int64 array of (0-based) exon starts
+    :param exon_ends: int64 array of (0-based, exclusive) exon ends
+    :param row_offsets: int64 array of the offsets of the exons of each model, as described above
+    :return tuple of int64 region lengths, uint8 region op codes (indexing _CIGAR_OPS), and int64 row offsets
+    :raises ValueError: if an exon is empty, or overlaps the previous exon of its model
+    """
+    n_exons = len(exon_starts)
+    exon_rows = np.repeat(np.arange(len(row_offsets) - 1), np.diff(row_offsets))
+    is_first = np.zeros(n_exons, dtype=bool)
+    is_first[row_offsets[:-1][row_offsets[:-1] < n_exons]] = True
+    if np.any(exon_ends <= exon_starts):
+        raise ValueError(f"Empty exon in exon model (row = {exon_rows[np.argmax(exon_ends <= exon_starts)]})")
+    intron_lengths = exon_starts[1:] - exon_ends[:-1]
+    overlapping = (intron_lengths < 0) & ~is_first[1:]
+    if np.any(overlapping):
+        raise ValueError(f"Overlapping exons in exon model (row = {exon_rows[np.argmax(overlapping) + 1]})")
+
+    # Exon i of row r is region 2 * i - r, and the intron before it, unless it is the first exon of its row, region
+    # 2 * i - r - 1
+    region_row_offsets = 2 * row_offsets - np.arange(len(row_offsets))
+    exon_regions = 2 * np.arange(n_exons) - exon_rows
+    lengths = np.empty(region_row_offsets[-1], dtype=np.int64)
+    ops = np.full(region_row_offsets[-1], _CIGAR_OP_CODES['N'], dtype=np.uint8)
+    lengths[exon_regions] = exon_ends - exon_starts
+    ops[exon_regions] = _CIGAR_OP_CODES['M']
+    lengths[exon_regions[1:][~is_first[1:]] - 1] = intron_lengths[~is_first[1:]]
+    return lengths, ops, region_row_offsets
+
+
+def _region_offsets(lengths, ops, row_offsets) -> (np.ndarray, np.ndarray):
+    """ Return two arrays holding, for each CIGAR region in the output of parse_cigar_strings, the transcript offset and
+    the genome offset (relative to mapping_start_pos) at which the region starts, restarting at 0 for every row. For
+    example, '8M7D6M2I' gives tx offsets [0, 8, 8, 14] and genome offsets [0, 8, 15, 21]. """
+    counts = np.diff(row_offsets)
+    offsets = []
+    for consumes in (_CONSUMES_TX, _CONSUMES_GENOME):
+        advance = lengths * consumes[ops]
+        region_offsets = np.cumsum(advance) - advance
+        region_offsets -= np.repeat(region_offsets[row_offsets[:-1][counts > 0]], counts[counts > 0])
+        offsets.append(region_offsets)
+    return tuple(offsets)
 
 
 class CIGARString:
     """ Class representing a CIGAR string describing a genomic mapping. Implemented as a list containing integer-char
-        tuples.
+        tuples, backed by compact arrays of region lengths and op codes.
+
+        Transcript length, aligned genome span and per-op base counts are computed once at construction and stored as
+        the attributes tx_length, genome_span and op_counts.
+
+        The CIGAR string describes the alignment along the forward strand of the genome. Transcripts on the minus
+        strand run against it, so their coordinate 0 is the last aligned base of the alignment; the region tables for
+        that direction are built the first time a minus-strand transcript is mapped, and then reused.
     """
-    def __init__(self, cigar_str):
-        self.cigar_str = cigar_str
-        self.cigar = self.__parse_cigar_str(cigar_str)
+    __slots__ = ('_cigar_str', 'cigar', 'tx_length', 'genome_span', 'op_counts', '_lengths', '_ops', '_tx_offsets',
+                 '_genome_offsets', '_tx_offsets_arr', '_genome_offsets_arr', '_minus_strand_tables')
+
+    def __init__(self, cigar_str, tokens=None):
+        """
+        :param cigar_str: CIGAR string, e.g. '8M7D6M2I', or None if tokens are given, in which case the CIGAR string is
+            only formatted from them when the cigar_str attribute is first read
+        :param tokens: optional tuple of region lengths, op codes, transcript offsets and genome offsets for
+            cigar_str, as sliced from the output of parse_cigar_strings (or exon_model_regions) and _region_offsets,
+            in which case cigar_str is not parsed again
+        """
+        self._cigar_str = cigar_str
+        if tokens is None:
+            tokens = self.__parse_cigar_str(cigar_str)
+        self._lengths, self._ops, self._tx_offsets_arr, self._genome_offsets_arr = tokens
+        self.cigar = list(zip(self._lengths.tolist(), [_CIGAR_OPS[op] for op in self._ops.tolist()]))
+
+        # Total number of bases per CIGAR op, e.g. {'M': 23, 'D': 18, 'I': 2} for '8M7D6M2I2M11D7M'
+        self.op_counts = {}
+        for region_length, region_type in self.cigar:
+            self.op_counts[region_type] = self.op_counts.get(region_type, 0) + region_length
+        self.tx_length = sum(self.op_counts.get(op, 0) for op in _TX_CONSUMING_OPS)
+        self.genome_span = sum(self.op_counts.get(op, 0) for op in _GENOME_CONSUMING_OPS)
+
+        # Region tables as NumPy arrays, used by the batch method map_coordinates, and as lists for bisect
+        self._tx_offsets = self._tx_offsets_arr.tolist()
+        self._genome_offsets = self._genome_offsets_arr.tolist()
+        self._minus_strand_tables = None
+
+    @property
+    def cigar_str(self) -> str:
+        if self._cigar_str is None:
+            self._cigar_str = ''.join(f'{region_length}{region_type}' for region_length, region_type in self.cigar)
+        return self._cigar_str
 
     @staticmethod
     def __parse_cigar_str(s):
-        """ Parse CIGAR string and return list containing integer-char tuples. Valid chars are M, D, I, S, H, =, X.
-        For example, the CIGAR str '8M7D6M2I' would return [('8', 'M'), ('7', 'D'), ('6', 'M'), ('2', 'I')] """
-        chars_list = [char for char in s if char.isalpha()]
-        int_list = re.split('[MDISH=X]', s)
-        int_list.pop()     # Remove empty string at the end of list
-        return list(zip([int(i) for i in int_list], chars_list))
-
-    def map_coordinate(self, tx_pos: int, mapping_start_pos: int) -> int:
+        """ Parse CIGAR string in a single pass of a compiled regex and return arrays of region lengths and op codes,
+        and of the transcript and genome offsets at which regions start. Valid chars are the SAM ops M, I, D, N, S, H,
+        P, =, X. For example, the CIGAR str '8M7D6M2I' would return lengths [8, 7, 6, 2] and op codes [0, 2, 0, 1], i.e.
+        the regions [(8, 'M'), (7, 'D'), (6, 'M'), (2, 'I')]
+
+        :raises ValueError: if s is not a valid CIGAR string
+        """
+        tokens = _CIGAR_TOKEN_RE.findall(s)
+        # Tokens only cover the whole string if it contains nothing but valid regions
+        if not tokens or sum(len(region_length) for region_length, _ in tokens) + len(tokens) != len(s):
+            raise ValueError(f"Invalid CIGAR string (CIGAR str = {s})")
+        # Same limit as parse_cigar_strings, whose digit sums must not overflow int64
+        if any(len(region_length) > 18 for region_length, _ in tokens):
+            raise ValueError("Invalid CIGAR string, region length does not fit in 64 bits")
+        lengths = np.array([int(region_length) for region_length, _ in tokens], dtype=np.int64)
+        ops = np.array([_CIGAR_OP_CODES[region_type] for _, region_type in tokens], dtype=np.uint8)
+        return (lengths, ops) + _region_offsets(lengths, ops, np.array([0, len(tokens)]))
+
+    def region_tables(self, strand: str = '+') -> tuple:
+        """ Return the region tables used to map transcript coordinates on the given strand, as a tuple of transcript
+        offsets and genome offsets (as lists and as arrays), op codes and direction along the genome (1 or -1). The
+        genome coordinate of transcript coordinate tx_pos in region r is then mapping_start_pos + genome_offsets[r] +
+        direction * (tx_pos - tx_offsets[r]).
+
+        On the '+' strand these are the tables computed at construction. On the '-' strand the regions are taken in
+        reverse order, so that transcript offsets count from the end of the alignment, and the genome offset of each
+        region is that of its last base, i.e. the base to the left of it for insertions.
+
+        :raises ValueError: if strand is neither '+' nor '-'
+        """
+        if strand == '+':
+            return self._tx_offsets, self._genome_offsets, self._tx_offsets_arr, self._genome_offsets_arr, self._ops, 1
+        if strand != '-':
+            raise ValueError(f"Invalid strand, expecting '+' or '-' (strand = {strand})")
+
+        if self._minus_strand_tables is None:
+            ops = self._ops[::-1].copy()
+            tx_advance = self._lengths[::-1] * _CONSUMES_TX[ops]
+            tx_offsets_arr = np.cumsum(tx_advance) - tx_advance
+            genome_offsets_arr = (self._genome_offsets_arr + self._lengths * _CONSUMES_GENOME[self._ops] - 1)[::-1]
+            genome_offsets_arr = genome_offsets_arr.copy()
+            self._minus_strand_tables = (tx_offsets_arr.tolist(), genome_offsets_arr.tolist(), tx_offsets_arr,
+                                         genome_offsets_arr, ops, -1)
+        return self._minus_strand_tables
+
+    def map_coordinate_status(self, tx_pos: int, mapping_start_pos: int, strand: str = '+') -> (int, MappingStatus):
+        """ Same as map_coordinate, also returning the MappingStatus of the coordinate, OK or IN_INSERTION, so that
+        coordinates in insertions are reported without a warning per call. Out-of-bounds coordinates return
+        (-1, MappingStatus.OUT_OF_BOUNDS) instead of raising.
+
+        :raises ValueError: if strand is invalid
+        """
+        tx_offsets, genome_offsets, _, _, _, direction = self.region_tables(strand)
+        if tx_pos < 0 or tx_pos >= self.tx_length:
+            return -1, MappingStatus.OUT_OF_BOUNDS
+
+        # Find the last region starting at or before tx_pos. Deletions do not consume transcript bases, so they share
+        # their tx offset with the next region and bisect_right skips past them.
+        region_ix = bisect.bisect_right(tx_offsets, tx_pos) - 1
+        genome_offset = genome_offsets[region_ix]
+
+        # Minus-strand tables hold the regions in reverse order
+        if self.cigar[region_ix if direction > 0 else -1 - region_ix][1] not in _GENOME_CONSUMING_OPS:
+            # Insertions and clips have no genomic coordinate, the genome offset of the region is the next base
+            # along the transcript
+            return mapping_start_pos + genome_offset, MappingStatus.IN_INSERTION
+
+        return mapping_start_pos + genome_offset + direction * (tx_pos - tx_offsets[region_ix]), MappingStatus.OK
+
+    def map_coordinate(self, tx_pos: int, mapping_start_pos: int, strand: str = '+') -> int:
         """ Translate a (0-based) transcript coordinate to a (0 based) genome coordinate. For example, for the mapping
         where mapping_start_pos=3 and the mapping is 8M7D6M2I2M11D7M, the fifth base in TR1 (i.e. TR1:4) maps to genome
-        coordinate CHR1:7.
+        coordinate CHR1:7, or to CHR1:39 if TR1 were on the minus strand.
 
-        Key strengths: Runs in O(N) time at worst, where N is the transcript length, and runs faster if there are large
-            deletions and insertions. Solution is very efficient in case of long chromosomes, since runtime does
-            not depend on chromosome length.
+        Key strengths: Runs in O(log R) time, where R is the number of regions in the CIGAR string, using a binary
+            search over the region offsets computed when the CIGARString is constructed. Runtime depends on neither
+            transcript nor chromosome length, nor on the strand.
 
-        Weaknesses / limitations:
-            * If there are many queries to a single chromosome, this is not the most efficient
-              solution, because alignments get re-calculated for each query, instead of storing mapped coordinates.
-            * Current implementation handles M (match), D (deletion), and I (insertion) regions only.
+        All SAM CIGAR ops are supported. Matches (M, =, X) map base by base, deletions and introns (D, N) are skipped
+        over on the genome, insertions and soft and hard clips (I, S, H) have no genomic coordinate, and padding (P) is
+        ignored, as it advances along neither sequence.
 
         This function was tested for cases such as tx_pos at the edge of a deletion or insertion region,
         tx_pos falling within a region, and tx_pos that is out-of-bounds considering the transcript length
 
+        Coordinates in insertions and clips have no genomic coordinate, and return the genomic coordinate next to
+        the insertion, along the transcript; map_coordinate_status also returns whether that is the case.
+
         :param tx_pos: integer representing query transcript coordinate that we are mapping
         :param mapping_start_pos: integer representing the genomic coordinate at which the transcript starts to align
+        :param strand: '+' or '-', the genome strand of the transcript
         :return integer representing genomic coordinate that the transcript coordinate maps to
-        :raises ValueError: if query transcript coordinate out-of-bounds
+        :raises ValueError: if query transcript coordinate out-of-bounds, or strand is invalid
         """
-
-        # Check that we have valid input coordinates
-        if tx_pos < 0 or tx_pos >= self.get_tx_length():
+        chrom_pos, status = self.map_coordinate_status(tx_pos, mapping_start_pos, strand)
+        if status == MappingStatus.OUT_OF_BOUNDS:
             raise ValueError(f"Transcript position out of bounds (tx_pos = {tx_pos}, transcript length "
-                             f"= {self.get_tx_length()}, CIGAR str = {self.cigar_str})")
-
-        # Initialize position at mapping_start_pos
-        curr_pos = mapping_start_pos
-
-        # Note type of alignment region we're in, e.g. match of length 8
-        curr_region_length = self.cigar[0][0]
-        curr_region_type = self.cigar[0][1]
-        region_ix = 0               # keep track of which region we're in, e.g. 8M is region 0
-        within_region_ix = 0        # which position within a region curr_pos is at, e.g. pos 0 within the 8M region
-        tx_ix = 0                   # which position of the transcript are we currently at
-        reached_end_of_region = False
-
-        # Step through transcript until we get to query position, adjusting curr_pos depending on whether we're in
-        # a region of match, deletion or insertion
-        while tx_ix < tx_pos:
-
-            if curr_region_type == 'M':
-                curr_pos += 1
-                within_region_ix += 1
-                if within_region_ix == (curr_region_length - 1):
-                    reached_end_of_region = True
-            elif curr_region_type == 'D':
-                curr_pos += curr_region_length + 1
-                reached_end_of_region = True        # jump over entire region and skip to next region
-            elif curr_region_type == 'I':
-                # skip ahead along transcript according to the size of insertion but only shift curr_pos up by one
-                tx_ix += curr_region_length
-                curr_pos += 1
-                reached_end_of_region = True
-
-                # Did we skip over our transcript coordinate? If so, warn that we have an invalid entry
-                if tx_pos <= tx_ix:
-                    warnings.warn(f"Transcript coordinate maps to insertion region and does not have a corresponding "
-                                  f"genomic coordinate. Returning genomic coordinate to the right of insertion. "
-                                  f"(tx_pos = {tx_pos}, CIGAR str = {self.cigar_str})")
-
-            # If we've reached the end of a region, update current region with whatever region comes next
-            if reached_end_of_region:
-                region_ix += 1
-                if region_ix < len(self.cigar):
-                    curr_region_length = self.cigar[region_ix][0]
-                    curr_region_type = self.cigar[region_ix][1]
-                    within_region_ix = 0
-                    reached_end_of_region = False
-
-            tx_ix += 1
-
-        return curr_pos
+                             f"= {self.tx_length}, CIGAR str = {self.cigar_str})")
+        return chrom_pos
+
+    def map_coordinates(self, tx_positions, mapping_start_pos: int, strand: str = '+') -> (np.ndarray, np.ndarray):
+        """ Batch version of map_coordinate, translating many (0-based) transcript coordinates in one vectorized pass.
+        Instead of raising or warning, problems are reported per coordinate in a status array of MappingStatus values.
+
+        :param tx_positions: sequence or array of integers representing query transcript coordinates
+        :param mapping_start_pos: integer representing the genomic coordinate at which the transcript starts to align
+        :param strand: '+' or '-', the genome strand of the transcript
+        :return tuple of two arrays of the same length as tx_positions: int64 genomic coordinates (-1 where out of
+            bounds), and int8 MappingStatus codes
+        """
+        _, _, tx_offsets, genome_offsets, ops, direction = self.region_tables(strand)
+        tx_positions = np.asarray(tx_positions, dtype=np.int64)
+        status = np.full(tx_positions.shape, MappingStatus.OK, dtype=np.int8)
+
+        out_of_bounds = (tx_positions < 0) | (tx_positions >= self.tx_length)
+        region_ix = np.searchsorted(tx_offsets, tx_positions, side='right') - 1
+        region_ix[out_of_bounds] = 0
+
+        # Positions within insertions take the genome offset of the region, i.e. the next base along the transcript
+        in_insertion = ~_CONSUMES_GENOME[ops[region_ix]] & ~out_of_bounds
+        within_region = np.where(in_insertion, 0, tx_positions - tx_offsets[region_ix])
+        chrom_positions = mapping_start_pos + genome_offsets[region_ix] + direction * within_region
+
+        chrom_positions[out_of_bounds] = -1
+        status[in_insertion] = MappingStatus.IN_INSERTION
+        status[out_of_bounds] = MappingStatus.OUT_OF_BOUNDS
+        return chrom_positions, status
+
+    def map_interval(self, tx_start: int, tx_end: int, mapping_start_pos: int, strand: str = '+') -> list:
+        """ Translate a (0-based, half-open) transcript interval [tx_start, tx_end) to the genomic blocks it projects
+        onto. The interval is split wherever a deletion or intron interrupts it on the genome, and the parts of it that
+        fall in insertions are reported as blocks of their own. For example, for the mapping where mapping_start_pos=3
+        and the mapping is 8M7D6M2I2M11D7M, TR1:[4, 16) maps to the blocks CHR1:[7, 11), CHR1:[18, 24) and the 2 bases
+        inserted at CHR1:24. Genomic blocks are always given as intervals on the forward strand, so on the minus strand
+        they are listed from the highest genome coordinate down.
+
+        Runs in O(log R + B) time, where B is the number of blocks, using a binary search for the first region of the
+        interval and then walking the regions it overlaps.
+
+        :param tx_start: integer representing the first transcript coordinate of the query interval
+        :param tx_end: integer representing the transcript coordinate after the last one of the query interval
+        :param mapping_start_pos: integer representing the genomic coordinate at which the transcript starts to align
+        :param strand: '+' or '-', the genome strand of the transcript
+        :return list of MappedBlock tuples, in transcript order, covering [tx_start, tx_end)
+        :raises ValueError: if query interval is empty or out-of-bounds, or strand is invalid
+        """
+        tx_offsets, genome_offsets, _, _, _, direction = self.region_tables(strand)
+        if tx_start < 0 or tx_end > self.tx_length or tx_start >= tx_end:
+            raise ValueError(f"Transcript interval out of bounds (tx_start = {tx_start}, tx_end = {tx_end}, transcript "
+                             f"length = {self.tx_length}, CIGAR str = {self.cigar_str})")
+
+        blocks = []
+        region_ix = bisect.bisect_right(tx_offsets, tx_start) - 1
+        while region_ix < len(self.cigar) and tx_offsets[region_ix] < tx_end:
+            region_length, region_type = self.cigar[region_ix if direction > 0 else -1 - region_ix]
+            region_tx_start = tx_offsets[region_ix]
+            genome_start = mapping_start_pos + genome_offsets[region_ix]
+            region_ix += 1
+            if region_type not in _TX_CONSUMING_OPS:
+                continue
+
+            block_start = max(tx_start, region_tx_start)
+            block_end = min(tx_end, region_tx_start + region_length)
+            if block_end <= block_start:
+                continue        # zero-length region, e.g. '0S', which neither forms nor splits a block
+            if region_type not in _GENOME_CONSUMING_OPS:
+                # The insertion lies between two genome bases, to the left of the next base on the forward strand
+                chrom_start = chrom_end = genome_start + (direction < 0)
+                status = MappingStatus.IN_INSERTION
+            elif direction > 0:
+                chrom_start = genome_start + (block_start - region_tx_start)
+                chrom_end, status = chrom_start + (block_end - block_start), MappingStatus.OK
+            else:
+                chrom_end = genome_start - (block_start - region_tx_start) + 1
+                chrom_start, status = chrom_end - (block_end - block_start), MappingStatus.OK
+
+            if blocks and blocks[-1].status == status and \
+                    (blocks[-1].chrom_end == chrom_start if direction > 0 else blocks[-1].chrom_start == chrom_end):
+                # Adjacent regions of the same kind, e.g. '5M0D5M' or '2I3I', form a single block
+                blocks[-1] = blocks[-1]._replace(tx_end=block_end, chrom_start=min(blocks[-1].chrom_start, chrom_start),
+                                                 chrom_end=max(blocks[-1].chrom_end, chrom_end))
+            else:
+                blocks.append(MappedBlock(block_start, block_end, chrom_start, chrom_end, status))
+        return blocks
+
+    def map_genome_coordinate(self, chrom_pos: int, mapping_start_pos: int, strand: str = '+') -> (int, MappingStatus):
+        """ Translate a (0-based) genome coordinate to a (0-based) transcript coordinate, i.e. the inverse of
+        map_coordinate. For example, for the mapping where mapping_start_pos=3 and the mapping is 8M7D6M2I2M11D7M,
+        CHR1:7 maps to TR1:4, and CHR1:12 falls in the 7D deletion, so TR1:8 (the next base along the transcript) is
+        reported.
+
+        Runs in O(log R) time, using a binary search over the genome offsets of the regions. Introns (N) are treated
+        like deletions.
+
+        :param chrom_pos: integer representing query genomic coordinate that we are mapping
+        :param mapping_start_pos: integer representing the genomic coordinate at which the transcript starts to align
+        :param strand: '+' or '-', the genome strand of the transcript
+        :return tuple containing integer representing transcript coordinate, and MappingStatus.OK, or
+            MappingStatus.IN_DELETION if chrom_pos falls in a deletion or intron and has no corresponding transcript
+            coordinate
+        :raises ValueError: if query genomic coordinate is outside the aligned span of the transcript, or strand is
+            invalid
+        """
+        direction = _STRAND_DIRECTIONS.get(strand)
+        if direction is None:
+            raise ValueError(f"Invalid strand, expecting '+' or '-' (strand = {strand})")
+        genome_offset = chrom_pos - mapping_start_pos
+        if genome_offset < 0 or genome_offset >= self.genome_span:
+            raise ValueError(f"Genome position outside transcript alignment (chrom_pos = {chrom_pos}, alignment = "
+                             f"[{mapping_start_pos}, {mapping_start_pos + self.genome_span}), CIGAR str = "
+                             f"{self.cigar_str})")
+
+        # Insertions and clips do not consume genome bases, so they share their genome offset with the next region
+        # and bisect_right skips past them. Positions are found on the forward strand, and then counted from the other
+        # end of the transcript on the minus strand.
+        region_ix = bisect.bisect_right(self._genome_offsets, genome_offset) - 1
+        if self.cigar[region_ix][1] not in _TX_CONSUMING_OPS:
+            tx_pos, status = self._tx_offsets[region_ix], MappingStatus.IN_DELETION
+            return (tx_pos if direction > 0 else self.tx_length - tx_pos), status
+        tx_pos = self._tx_offsets[region_ix] + (genome_offset - self._genome_offsets[region_ix])
+        return (tx_pos if direction > 0 else self.tx_length - 1 - tx_pos), MappingStatus.OK
+
+    def map_genome_coordinates(self, chrom_positions, mapping_start_pos: int,
+                               strand: str = '+') -> (np.ndarray, np.ndarray):
+        """ Batch version of map_genome_coordinate, translating many (0-based) genome coordinates in one vectorized
+        pass, with out-of-bounds coordinates reported in the status array instead of raising.
+
+        :param chrom_positions: sequence or array of integers representing query genomic coordinates
+        :param mapping_start_pos: integer representing the genomic coordinate at which the transcript starts to align
+        :param strand: '+' or '-', the genome strand of the transcript
+        :return tuple of two arrays of the same length as chrom_positions: int64 transcript coordinates (-1 where out
+            of bounds), and int8 MappingStatus codes
+        """
+        direction = _STRAND_DIRECTIONS.get(strand)
+        if direction is None:
+            raise ValueError(f"Invalid strand, expecting '+' or '-' (strand = {strand})")
+        genome_offsets = np.asarray(chrom_positions, dtype=np.int64) - mapping_start_pos
+        status = np.full(genome_offsets.shape, MappingStatus.OK, dtype=np.int8)
+
+        out_of_bounds = (genome_offsets < 0) | (genome_offsets >= self.genome_span)
+        region_ix = np.searchsorted(self._genome_offsets_arr, genome_offsets, side='right') - 1
+        region_ix[out_of_bounds] = 0
+
+        # Positions within deletions take the transcript offset of the region, i.e. the next base along the transcript
+        in_deletion = ~_CONSUMES_TX[self._ops[region_ix]] & ~out_of_bounds
+        within_region = np.where(in_deletion, 0, genome_offsets - self._genome_offsets_arr[region_ix])
+        tx_positions = self._tx_offsets_arr[region_ix] + within_region
+        if direction < 0:
+            tx_positions = np.where(in_deletion, self.tx_length, self.tx_length - 1) - tx_positions
+
+        tx_positions[out_of_bounds] = -1
+        status[in_deletion] = MappingStatus.IN_DELETION
+        status[out_of_bounds] = MappingStatus.OUT_OF_BOUNDS
+        return tx_positions, status
 
     def get_tx_length(self):
-        """ Calculate transcript length by adding up lengths of match and insertion regions """
-        region_lengths = [region[0] for region in self.cigar if region[1] in ['M', 'I']]
-        return sum(region_lengths)
+        """ Return transcript length, i.e. the total length of match, insertion and clip regions """
+        return self.tx_length
+
+
+class CIGARCache:
+    """ Bounded least-recently-used cache of parsed CIGARString objects, keyed by CIGAR string. Mapping does not modify
+    a CIGARString, so transcripts with identical CIGAR strings share one parsed object.
+    """
+    def __init__(self, maxsize: int = _CIGAR_CACHE_SIZE):
+        """
+        :param maxsize: maximum number of CIGARString objects kept, 0 disables caching
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+
+    def get(self, cigar_str: str) -> CIGARString:
+        """ Return parsed CIGARString for cigar_str, parsing it only if not already cached """
+        cigar = self._lookup(cigar_str)
+        if cigar is None:
+            self.misses += 1
+            cigar = CIGARString(cigar_str)
+            self._insert(cigar_str, cigar)
+        else:
+            self.hits += 1
+        return cigar
+
+    def get_many(self, cigar_strs) -> list:
+        """ Return list of parsed CIGARStrings for a column of CIGAR strings. The distinct strings that are not already
+        cached are parsed together in one pass of parse_cigar_strings.
+
+        :raises ValueError: if any of the strings is not a valid CIGAR string
+        """
+        cigars = [self._lookup(cigar_str) for cigar_str in cigar_strs]
+        missing = list(dict.fromkeys(cigar_str for cigar_str, cigar in zip(cigar_strs, cigars) if cigar is None))
+        self.misses += len(missing)
+        self.hits += len(cigar_strs) - len(missing)
+        lengths, ops, row_offsets = parse_cigar_strings(missing)
+        tx_offsets, genome_offsets = _region_offsets(lengths, ops, row_offsets)
+        parsed = {}
+        for cigar_str, start, end in zip(missing, row_offsets[:-1].tolist(), row_offsets[1:].tolist()):
+            parsed[cigar_str] = CIGARString(cigar_str, (lengths[start:end], ops[start:end],
+                                                        tx_offsets[start:end], genome_offsets[start:end]))
+            self._insert(cigar_str, parsed[cigar_str])
+        return [parsed[cigar_str] if cigar is None else cigar for cigar_str, cigar in zip(cigar_strs, cigars)]
+
+    def _lookup(self, cigar_str: str):
+        """ Return cached CIGARString for cigar_str, or None, marking it as most recently used """
+        cigar = self._cache.get(cigar_str)
+        if cigar is not None:
+            self._cache.move_to_end(cigar_str)
+        return cigar
+
+    def _insert(self, cigar_str: str, cigar: CIGARString):
+        if self.maxsize > 0:
+            self._cache[cigar_str] = cigar
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __str__(self):
+        return f'{self.hits} hits, {self.misses} misses, {len(self)}/{self.maxsize} entries'
+
+
+# Compact per-transcript entry of a TranscriptIndex
+TranscriptRecord = collections.namedtuple('TranscriptRecord', ['chrom_code', 'mapping_start_pos', 'cigar', 'strand'])
+
+# Filter on the records of a SAM file loaded with TranscriptIndex.load_sam: records with MAPQ below min_mapq, or with
+# any of the FLAG bits in exclude_flags set, are skipped
+SAMFilter = collections.namedtuple('SAMFilter', ['min_mapq', 'exclude_flags'], defaults=[0, _SAM_EXCLUDE_FLAGS])
+
+
+class TranscriptIndex:
+    """ Hash index of transcript mappings, holding one TranscriptRecord per alignment of each transcript ID. Chromosome
+    IDs are stored once in self.chroms and referenced from records by their code. CIGAR strings are parsed when added,
+    through self.cigar_cache so that a CIGAR string shared by many transcripts is only parsed once.
+
+    A transcript ID added more than once, e.g. for paralogs or alternative contigs, has several alignments, numbered
+    in the order they were added. Lookups by transcript ID return the first (primary) alignment, and alignments()
+    returns all of them.
+    """
+    def __init__(self, cigar_cache_size: int = _CIGAR_CACHE_SIZE):
+        """
+        :param cigar_cache_size: maximum number of distinct parsed CIGAR strings kept for reuse
+        """
+        self.cigar_cache = CIGARCache(cigar_cache_size)
+        self.chroms = []            # chromosome code -> chromosome ID
+        self._chrom_codes = {}      # chromosome ID -> chromosome code
+        self._records = {}          # transcript ID -> TranscriptRecord of the first alignment
+        self._more_records = {}     # transcript ID -> list of TranscriptRecords of further alignments, if any
+
+    @classmethod
+    def load(cls, transcripts_fn, cigar_cache_size: int = _CIGAR_CACHE_SIZE):
+        """ Build index from tab-delimited file with columns [tx_id, chrom_id, mapping_start_pos, CIGAR_str] and an
+        optional fifth column [strand], '+' or '-', and no header. Transcripts without a strand are on the '+' strand.
+
+        :raises ValueError: if a line does not contain 4 or 5 values, or a CIGAR string or strand is invalid
+        """
+        transcripts = cls(cigar_cache_size)
+        with _open_text(transcripts_fn, newline='') as transcripts_file:
+            rows = (row for row in csv.reader(transcripts_file, delimiter='\t', quoting=csv.QUOTE_NONE) if row)
+            while True:
+                chunk = list(itertools.islice(rows, _QUERY_CHUNK_SIZE))
+                if not chunk:
+                    break
+                for row_ix, row in enumerate(chunk):
+                    if len(row) == 4:
+                        chunk[row_ix] = row + ['+']
+                    elif len(row) != 5:
+                        raise ValueError(f"Error parsing transcripts file, expecting 4 or 5 values, check formatting "
+                                         f"in line: {row}")
+                transcripts.add_many(*zip(*chunk))
+        return transcripts
+
+    @classmethod
+    def load_columnar(cls, transcripts_fn, cigar_cache_size: int = _CIGAR_CACHE_SIZE):
+        """ Build index from Parquet or Arrow IPC file holding the columns of load, i.e. [tx_id, chrom_id,
+        mapping_start_pos, CIGAR_str] and optionally [strand], in that order whatever their names. Only these columns
+        are read, one record batch (or Parquet row group) at a time. pyarrow is only imported when this is called.
+
+        :raises ValueError: if the file has fewer than 4 columns, a column has null values, or a CIGAR string or strand
+            is invalid
+        """
+        transcripts = cls(cigar_cache_size)
+        for batch in _read_columnar_batches(transcripts_fn, _QUERY_CHUNK_SIZE, n_columns=5):
+            if batch.num_columns < 4:
+                raise ValueError(f"Error parsing transcripts file, expecting 4 or 5 columns, found {batch.num_columns}")
+            columns = [_columnar_to_list(column) for column in batch.columns]
+            transcripts.add_many(*columns)
+        return transcripts
+
+    @classmethod
+    def load_annotation(cls, annotation_fn, cigar_cache_size: int = _CIGAR_CACHE_SIZE):
+        """ Build index from the exon records of a GTF or GFF3 annotation file, streaming through the file and keeping
+        only the exons. Exons are grouped by transcript, using the transcript_id attribute (GTF) or the Parent attribute
+        without a leading 'transcript:' (GFF3), and each transcript is aligned from the start of its first exon, with
+        exons as M regions and introns as N regions, on the strand of its exons ('+' unless it is '-'). Region tables
+        are built for all transcripts at once with exon_model_regions, without formatting CIGAR strings.
+
+        :raises ValueError: if a feature line does not contain 9 values, an exon has no transcript ID, or the exons of
+            a transcript are on different chromosomes or strands, or overlap
+        """
+        transcripts = cls(cigar_cache_size)
+        tx_codes = {}
+        exon_tx, exon_chroms, exon_starts, exon_ends, exon_strands = [], [], [], [], []
+        with _open_text(annotation_fn) as annotation_file:
+            for line in annotation_file:
+                if line.startswith('#'):
+                    if line.startswith('##FASTA'):
+                        break       # GFF3 sequences follow
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 9:
+                    if not line.strip():
+                        continue
+                    raise ValueError(f"Error parsing annotation file, expecting 9 values, check formatting in line: "
+                                     f"{line}")
+                if fields[2] != 'exon':
+                    continue
+
+                match = _ANNOTATION_TX_ID_RE.search(fields[8])
+                if match is None:
+                    raise ValueError(f"Exon without transcript_id or Parent attribute in annotation file: {line}")
+                tx_ids = [match.group(1)] if match.group(1) is not None else match.group(2).split(',')
+                for tx_id in tx_ids:
+                    if tx_id.startswith('transcript:'):
+                        tx_id = tx_id[len('transcript:'):]
+                    exon_tx.append(tx_codes.setdefault(tx_id, len(tx_codes)))
+                    exon_chroms.append(fields[0])
+                    exon_starts.append(fields[3])
+                    exon_ends.append(fields[4])
+                    exon_strands.append(fields[6])
+
+        # Sort exons by transcript and start, converting 1-based, inclusive coordinates to 0-based, half-open ones
+        exon_tx = np.array(exon_tx, dtype=np.int64)
+        exon_starts = np.array(exon_starts, dtype=np.int64) - 1
+        exon_ends = np.array(exon_ends, dtype=np.int64)
+        order = np.lexsort((exon_starts, exon_tx))
+        exon_tx, exon_starts, exon_ends = exon_tx[order], exon_starts[order], exon_ends[order]
+        exon_chroms = np.array(exon_chroms, dtype=object)[order]
+        exon_strands = np.array(exon_strands, dtype=object)[order]
+        row_offsets = np.searchsorted(exon_tx, np.arange(len(tx_codes) + 1))
+
+        first_exons = row_offsets[:-1]
+        counts = np.diff(row_offsets)
+        for values, name in ((exon_chroms, 'chromosomes'), (exon_strands, 'strands')):
+            differs = values != np.repeat(values[first_exons], counts)
+            if np.any(differs):
+                tx_id = list(tx_codes)[exon_tx[np.argmax(differs)]]
+                raise ValueError(f"Exons of transcript on different {name} in annotation file (tx_id = {tx_id})")
+
+        try:
+            lengths, ops, region_row_offsets = exon_model_regions(exon_starts, exon_ends, row_offsets)
+        except ValueError as e:
+            raise ValueError(f"{e} in annotation file: {annotation_fn}") from None
+        tx_offsets, genome_offsets = _region_offsets(lengths, ops, region_row_offsets)
+        for tx_id, chrom_id, mapping_start_pos, strand, start, end in zip(
+                tx_codes, exon_chroms[first_exons].tolist(), exon_starts[first_exons].tolist(),
+                exon_strands[first_exons].tolist(), region_row_offsets[:-1].tolist(), region_row_offsets[1:].tolist()):
+            cigar = CIGARString(None, (lengths[start:end], ops[start:end], tx_offsets[start:end],
+                                       genome_offsets[start:end]))
+            transcripts._add_record(tx_id, chrom_id, mapping_start_pos, cigar, '-' if strand == '-' else '+')
+        return transcripts
+
+    @classmethod
+    def load_sam(cls, sam_fn, cigar_cache_size: int = _CIGAR_CACHE_SIZE, sam_filter: SAMFilter = SAMFilter()):
+        """ Build index from the alignment records of a SAM file of transcripts aligned to the genome, streaming through
+        the file in chunks of records that are filtered and added in bulk. Each record is an alignment of transcript
+        QNAME to chromosome RNAME, at 1-based position POS, with its CIGAR string, on the '-' strand if FLAG has the
+        reverse bit (0x10) set and on the '+' strand otherwise. Header lines, and records without a CIGAR string ('*'),
+        are skipped.
+
+        :param sam_filter: SAMFilter selecting the records to load. By default, unmapped, secondary, QC-failed and
+            supplementary records are skipped; secondary and supplementary records that are loaded are added after all
+            others, as further alignments of their transcripts
+        :raises ValueError: if a record does not contain the mandatory SAM fields, or a CIGAR string is invalid
+        """
+        transcripts = cls(cigar_cache_size)
+        not_primary_chunks = []
+        with _open_text(sam_fn) as sam_file:
+            records = (line for line in sam_file if not line.startswith('@') and line.strip())
+            while True:
+                lines = list(itertools.islice(records, _QUERY_CHUNK_SIZE))
+                if not lines:
+                    break
+                # Splitting off at most 10 fields leaves 11 values for records with all 11 mandatory fields, the
+                # optional tags staying joined to the last one
+                chunk = [line.split('\t', 10) for line in lines]
+                for line, fields in zip(lines, chunk):
+                    if len(fields) != 11:
+                        raise ValueError(f"Error parsing SAM file, expecting at least 11 values, check formatting "
+                                         f"in line: {line}")
+                tx_ids, flags, chrom_ids, positions, mapqs, cigar_strs = list(zip(*chunk))[:6]
+                flags = np.array(flags, dtype=np.int64)
+                cigar_strs = np.array(cigar_strs, dtype=object)
+                keep = ((flags & sam_filter.exclude_flags) == 0) & (cigar_strs != '*')
+                if sam_filter.min_mapq > 0:
+                    keep &= np.array(mapqs, dtype=np.int64) >= sam_filter.min_mapq
+
+                # Columns of the kept records, with 0-based positions
+                columns = (np.array(tx_ids, dtype=object), np.array(chrom_ids, dtype=object),
+                           np.array(positions, dtype=np.int64) - 1, cigar_strs,
+                           np.where(flags & _SAM_FLAG_REVERSE, '-', '+').astype(object))
+                not_primary = (flags & _SAM_FLAG_NOT_PRIMARY) != 0
+                if np.any(keep & not_primary):
+                    not_primary_chunks.append([column[keep & not_primary] for column in columns])
+                    keep &= ~not_primary
+                transcripts.add_many(*(column[keep].tolist() for column in columns))
+
+        for columns in not_primary_chunks:
+            transcripts.add_many(*(column.tolist() for column in columns))
+        return transcripts
+
+    @classmethod
+    def load_any(cls, transcripts_fn, cigar_cache_size: int = _CIGAR_CACHE_SIZE, sam_filter: SAMFilter = SAMFilter()):
+        """ Build index with load_columnar if transcripts_fn is a Parquet or Arrow IPC file, by its magic bytes, with
+        load_annotation if it is a GTF or GFF3 file, with load_sam (using sam_filter) if it is a SAM file, by its
+        extension (ignoring a trailing '.gz' or '.bgz'), and with load otherwise """
+        if _columnar_format(transcripts_fn) is not None:
+            return cls.load_columnar(transcripts_fn, cigar_cache_size)
+        name = transcripts_fn.lower()
+        if name.endswith(_COMPRESSED_EXTENSIONS):
+            name = name.rsplit('.', 1)[0]
+        if name.endswith(_ANNOTATION_EXTENSIONS):
+            return cls.load_annotation(transcripts_fn, cigar_cache_size)
+        if name.endswith('.sam'):
+            return cls.load_sam(transcripts_fn, cigar_cache_size, sam_filter)
+        return cls.load(transcripts_fn, cigar_cache_size)
+
+    def add(self, tx_id: str, chrom_id: str, mapping_start_pos: int, cigar_str: str, strand: str = '+'):
+        """ Add transcript mapping to the index, parsing the CIGAR string unless it is in the CIGAR cache
+
+        :raises ValueError: if strand is neither '+' nor '-'
+        """
+        self._add_record(tx_id, chrom_id, mapping_start_pos, self.cigar_cache.get(cigar_str), strand)
+
+    def add_many(self, tx_ids, chrom_ids, mapping_start_positions, cigar_strs, strands=None):
+        """ Add a column of transcript mappings to the index, parsing all uncached CIGAR strings in one bulk pass. All
+        transcripts are on the '+' strand unless strands is given.
+
+        :raises ValueError: if a CIGAR string or strand is invalid
+        """
+        cigars = self.cigar_cache.get_many(cigar_strs)
+        if strands is None:
+            strands = itertools.repeat('+')
+        for tx_id, chrom_id, mapping_start_pos, cigar, strand in zip(tx_ids, chrom_ids, mapping_start_positions,
+                                                                     cigars, strands):
+            self._add_record(tx_id, chrom_id, int(mapping_start_pos), cigar, strand)
+
+    def _add_record(self, tx_id: str, chrom_id: str, mapping_start_pos: int, cigar: CIGARString, strand: str):
+        if strand not in _STRAND_DIRECTIONS:
+            raise ValueError(f"Invalid strand in transcript mappings, expecting '+' or '-' (tx_id = {tx_id}, strand = "
+                             f"{strand})")
+        chrom_code = self._chrom_codes.get(chrom_id)
+        if chrom_code is None:
+            chrom_code = self._chrom_codes[chrom_id] = len(self.chroms)
+            self.chroms.append(chrom_id)
+        record = TranscriptRecord(chrom_code, mapping_start_pos, cigar, strand)
+        if tx_id in self._records:
+            self._more_records.setdefault(tx_id, []).append(record)
+        else:
+            self._records[tx_id] = record
+
+    def __getitem__(self, tx_id: str) -> TranscriptRecord:
+        return self._records[tx_id]
+
+    def __contains__(self, tx_id: str) -> bool:
+        return tx_id in self._records
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def records(self):
+        """ Return view of (tx_id, TranscriptRecord) pairs of primary alignments in the order transcripts were added """
+        return self._records.items()
+
+    def alignments(self, tx_id: str) -> list:
+        """ Return list of TranscriptRecords of all alignments of tx_id, the primary alignment first
+
+        :raises KeyError: if tx_id is not in the index
+        """
+        return [self._records[tx_id]] + self._more_records.get(tx_id, [])
+
+    def to_dataframe(self):
+        """ Return pandas DataFrame with columns [tx_id, alignment_ix, chrom_id, mapping_start_pos, CIGAR_str, strand]
+        and one row per alignment, indexed by (tx_id, alignment_ix). pandas is only imported when this is called. """
+        import pandas as pd
+        return pd.DataFrame([(tx_id, alignment_ix, self.chroms[record.chrom_code], record.mapping_start_pos,
+                              record.cigar.cigar_str, record.strand)
+                             for tx_id in self for alignment_ix, record in enumerate(self.alignments(tx_id))],
+                            columns=['tx_id', 'alignment_ix', 'chrom_id', 'mapping_start_pos', 'CIGAR_str',
+                                     'strand']).set_index(['tx_id', 'alignment_ix'])
+
+    def map_queries(self, tx_ids, tx_positions) -> (np.ndarray, np.ndarray, np.ndarray):
+        """ Translate a chunk of (0-based) transcript coordinates, each on its own transcript, to (0-based) genome
+        coordinates by grouping the queries by transcript and mapping each group with one CIGARString.map_coordinates
+        call, using the primary alignment of the transcript. Results are returned in the original query order, in the
+        same form as SegmentTable.map_queries.
+
+        :param tx_ids: sequence of transcript IDs, one per query
+        :param tx_positions: sequence or array of integers representing query transcript coordinates
+        :return tuple of three arrays of the same length as tx_ids: int32 chromosome codes indexing self.chroms (-1
+            for unknown transcripts), int64 genomic coordinates (-1 where not mapped), and int8 MappingStatus codes
+        """
+        tx_positions = np.asarray(tx_positions, dtype=np.int64)
+        chrom_codes = np.full(tx_positions.shape, -1, dtype=np.int32)
+        chrom_positions = np.full(tx_positions.shape, -1, dtype=np.int64)
+        status = np.full(tx_positions.shape, MappingStatus.UNKNOWN_TX, dtype=np.int8)
+
+        # Number transcripts in order of first appearance, then sort queries by that number to get contiguous groups
+        group_codes = {}
+        query_groups = np.fromiter((group_codes.setdefault(tx_id, len(group_codes)) for tx_id in tx_ids),
+                                   dtype=np.int64, count=len(tx_ids))
+        order = np.argsort(query_groups, kind='stable')
+        group_sizes = np.bincount(query_groups, minlength=len(group_codes))
+        group_ends = np.cumsum(group_sizes)
+
+        for tx_id, group_start, group_end in zip(group_codes, group_ends - group_sizes, group_ends):
+            tx_mapping = self._records.get(tx_id)
+            if tx_mapping is None:
+                continue
+            rows = order[group_start:group_end]
+            chrom_positions[rows], status[rows] = tx_mapping.cigar.map_coordinates(
+                tx_positions[rows], tx_mapping.mapping_start_pos, tx_mapping.strand)
+            chrom_codes[rows] = tx_mapping.chrom_code
+        return chrom_codes, chrom_positions, status
+
+
+class _HashedTxCodes:
+    """ Read-only mapping of transcript ID to transcript code, backed by the arrays of a binary index file: transcript
+    IDs stored back to back as UTF-8 bytes, and an open-addressing hash table (CRC32 with linear probing) of codes.
+    Supports the dict methods SegmentTable uses, and remembers lookups of up to _QUERY_CHUNK_SIZE IDs.
+    """
+    def __init__(self, id_offsets: np.ndarray, id_bytes: np.ndarray, slots: np.ndarray):
+        self._id_offsets = id_offsets
+        self._id_bytes = memoryview(id_bytes)
+        self._slots = slots
+        self._lookups = {}
+
+    @staticmethod
+    def build_arrays(tx_ids) -> dict:
+        """ Return the arrays backing a _HashedTxCodes for transcript IDs given in code order """
+        encoded_ids = [tx_id.encode() for tx_id in tx_ids]
+        id_offsets = np.zeros(len(encoded_ids) + 1, dtype=np.int64)
+        np.cumsum([len(encoded_id) for encoded_id in encoded_ids], out=id_offsets[1:])
+        id_bytes = np.frombuffer(b''.join(encoded_ids), dtype=np.uint8)
+
+        # Power-of-two table at most half full, so that probe sequences stay short
+        slots = np.full(1 << max(len(encoded_ids) * 2 - 1, 1).bit_length(), -1, dtype=np.int64)
+        mask = len(slots) - 1
+        for code, encoded_id in enumerate(encoded_ids):
+            slot_ix = zlib.crc32(encoded_id) & mask
+            while slots[slot_ix] >= 0:
+                slot_ix = (slot_ix + 1) & mask
+            slots[slot_ix] = code
+        return {'tx_id_offsets': id_offsets, 'tx_id_bytes': id_bytes, 'tx_id_slots': slots}
+
+    def get(self, tx_id: str, default=None):
+        code = self._lookups.get(tx_id)
+        if code is None:
+            if len(self._lookups) >= _QUERY_CHUNK_SIZE:
+                self._lookups.clear()
+            code = self._lookups[tx_id] = self._lookup(tx_id)
+        return default if code < 0 else code
+
+    def _lookup(self, tx_id: str) -> int:
+        encoded_id = tx_id.encode()
+        mask = len(self._slots) - 1
+        slot_ix = zlib.crc32(encoded_id) & mask
+        while True:
+            code = int(self._slots[slot_ix])
+            if code < 0 or self._id_bytes[self._id_offsets[code]:self._id_offsets[code + 1]] == encoded_id:
+                return code
+            slot_ix = (slot_ix + 1) & mask
+
+    def __contains__(self, tx_id: str) -> bool:
+        return self.get(tx_id) is not None
+
+    def __iter__(self):
+        for start, end in zip(self._id_offsets[:-1].tolist(), self._id_offsets[1:].tolist()):
+            yield bytes(self._id_bytes[start:end]).decode()
+
+    def __len__(self):
+        return len(self._id_offsets) - 1
+
+
+class SegmentTable:
+    """ Flattened table of the CIGAR regions ('segments') of all transcripts, stored as a struct of NumPy arrays so that
+    a whole chunk of queries can be mapped with a single np.searchsorted.
+
+    Each transcript ID is assigned a transcript code, and each of its alignments an alignment code; the alignments of
+    transcript code c have the alignment codes [tx_alignment_offsets[c], tx_alignment_offsets[c + 1]), the first one
+    being the primary alignment. All other per-transcript arrays (chrom_codes, tx_strands, tx_lengths and
+    tx_key_offsets) and seg_tx are indexed by alignment code. For transcripts with a single alignment, both codes
+    are the same.
+
+    Each alignment is assigned a block of the global key space, so the key of transcript coordinate tx_pos is
+    tx_key_offsets[alignment_code] + tx_pos. Segments of all alignments are laid out in the same key space, sorted by
+    key. Segments of minus-strand transcripts are taken from the reversed region tables of their CIGARString, and
+    tx_strands holds the direction (1 or -1) in which each alignment runs along the genome.
+
+    The arrays can be copied to shared memory with to_shared_memory, and other processes can then attach to them
+    without copying with attach_shared_memory. They can also be saved to a binary index file with save, and opened
+    again memory-mapped with open, in which case self.path is the path of the index file.
+    """
+    # Names of the NumPy array attributes holding the table
+    _ARRAY_FIELDS = ('tx_alignment_offsets', 'chrom_codes', 'tx_strands', 'tx_lengths', 'tx_key_offsets', 'seg_tx',
+                     'seg_keys', 'seg_genome', 'seg_ops')
+
+    def __init__(self, transcripts: TranscriptIndex):
+        """
+        :param transcripts: TranscriptIndex containing mappings of all transcripts; transcript codes follow its order
+        """
+        self.path = None
+        self.tx_codes = {tx_id: code for code, tx_id in enumerate(transcripts)}
+        self.chroms = transcripts.chroms
+        alignments = [transcripts.alignments(tx_id) for tx_id in transcripts]
+        records = [record for tx_alignments in alignments for record in tx_alignments]
+        self.tx_alignment_offsets = np.zeros(len(alignments) + 1, dtype=np.int64)
+        np.cumsum([len(tx_alignments) for tx_alignments in alignments], out=self.tx_alignment_offsets[1:])
+        self.chrom_codes = np.array([record.chrom_code for record in records], dtype=np.int32)
+        cigars = [record.cigar for record in records]
+        self.tx_strands = np.array([_STRAND_DIRECTIONS[record.strand] for record in records], dtype=np.int8)
+        region_tables = [record.cigar.region_tables(record.strand) for record in records]
+
+        self.tx_lengths = np.array([cigar.tx_length for cigar in cigars], dtype=np.int64)
+        self.tx_key_offsets = np.zeros(len(cigars), dtype=np.int64)
+        np.cumsum(self.tx_lengths[:-1], out=self.tx_key_offsets[1:])
+
+        n_regions = np.array([len(cigar.cigar) for cigar in cigars], dtype=np.int64)
+        self.seg_tx = np.repeat(np.arange(len(cigars), dtype=np.int32), n_regions)
+        self.seg_keys = np.repeat(self.tx_key_offsets, n_regions)
+        self.seg_genome = np.repeat(np.array([record.mapping_start_pos for record in records], dtype=np.int64),
+                                    n_regions)
+        if len(cigars):
+            self.seg_keys += np.concatenate([tables[2] for tables in region_tables])
+            self.seg_genome += np.concatenate([tables[3] for tables in region_tables])
+            self.seg_ops = np.concatenate([tables[4] for tables in region_tables])
+        else:
+            self.seg_ops = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.tx_alignment_offsets) - 1
+
+    def to_shared_memory(self) -> (list, dict):
+        """ Copy the arrays of the table, and a hash table of its transcript IDs as stored in binary index files, into
+        multiprocessing.shared_memory blocks.
+
+        :return tuple containing the list of SharedMemory blocks, which the caller must close and unlink once no
+            process uses them anymore, and a picklable description of the table to pass to attach_shared_memory
+        """
+        import multiprocessing.shared_memory
+        blocks = []
+        spec = {'chroms': list(self.chroms), 'arrays': {}}
+        arrays = {name: getattr(self, name) for name in self._ARRAY_FIELDS}
+        arrays.update(_HashedTxCodes.build_arrays(self.tx_codes))
+        for name, array in arrays.items():
+            block = multiprocessing.shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            blocks.append(block)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+            spec['arrays'][name] = (block.name, array.shape, array.dtype.str)
+        return blocks, spec
+
+    @classmethod
+    def attach_shared_memory(cls, spec: dict):
+        """ Return a SegmentTable whose arrays are views of the shared memory blocks described by spec, as returned by
+        to_shared_memory. Transcript IDs are looked up in the shared hash table, as for tables opened from a binary
+        index file.
+        """
+        import multiprocessing.shared_memory
+        table = cls.__new__(cls)
+        table.path = None
+        table.chroms = spec['chroms']
+        table._shared_blocks = []       # keep blocks open for as long as the table uses them
+        arrays = {}
+        for name, (block_name, shape, dtype) in spec['arrays'].items():
+            block = multiprocessing.shared_memory.SharedMemory(name=block_name)
+            table._shared_blocks.append(block)
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        table.tx_codes = _HashedTxCodes(arrays.pop('tx_id_offsets'), arrays.pop('tx_id_bytes'),
+                                        arrays.pop('tx_id_slots'))
+        for name, array in arrays.items():
+            setattr(table, name, array)
+        return table
+
+    def save(self, index_fn):
+        """ Write the table to a binary index file that SegmentTable.open can memory-map. The file holds the table
+        arrays, a hash table of transcript IDs, the chromosome IDs and a CRC32 checksum of the array data. """
+        arrays = {name: getattr(self, name) for name in self._ARRAY_FIELDS}
+        arrays.update(_HashedTxCodes.build_arrays(self.tx_codes))
+
+        header = {'chroms': list(self.chroms), 'arrays': {}, 'checksum': 0}
+        data_size = 0
+        for name, array in arrays.items():
+            header['arrays'][name] = (data_size, array.shape, array.dtype.str)
+            data_size += -(-array.nbytes // _INDEX_ALIGNMENT) * _INDEX_ALIGNMENT
+        for array in arrays.values():
+            header['checksum'] = zlib.crc32(self._padded_bytes(array), header['checksum'])
+
+        header_bytes = json.dumps(header).encode()
+        preamble = _INDEX_MAGIC + _INDEX_PREAMBLE.pack(_INDEX_VERSION, len(header_bytes)) + header_bytes
+        with open(index_fn, 'wb') as index_file:
+            index_file.write(preamble + bytes(-len(preamble) % _INDEX_ALIGNMENT))
+            for array in arrays.values():
+                index_file.write(self._padded_bytes(array))
+
+    @staticmethod
+    def _padded_bytes(array: np.ndarray) -> bytes:
+        data = np.ascontiguousarray(array).tobytes()
+        return data + bytes(-len(data) % _INDEX_ALIGNMENT)
+
+    @staticmethod
+    def is_index_file(fn) -> bool:
+        """ Return True if fn starts with the magic bytes of a binary index file written by SegmentTable.save """
+        with open(fn, 'rb') as f:
+            return f.read(len(_INDEX_MAGIC)) == _INDEX_MAGIC
+
+    @classmethod
+    def open(cls, index_fn, verify: bool = False):
+        """ Open a binary index file written by SegmentTable.save, memory-mapping its arrays so that startup does not
+        depend on the number of transcripts and pages are only read from disk when used.
+
+        :param index_fn: path to binary index file
+        :param verify: if True, read all array data and check it against the checksum stored in the file
+        :raises ValueError: if the file is not an index file, has an unsupported version, or fails verification
+        """
+        with open(index_fn, 'rb') as index_file:
+            preamble = index_file.read(len(_INDEX_MAGIC) + _INDEX_PREAMBLE.size)
+            if preamble[:len(_INDEX_MAGIC)] != _INDEX_MAGIC:
+                raise ValueError(f"Not a transcript index file: {index_fn}")
+            version, header_length = _INDEX_PREAMBLE.unpack(preamble[len(_INDEX_MAGIC):])
+            if version != _INDEX_VERSION:
+                raise ValueError(f"Unsupported transcript index version {version} (expected {_INDEX_VERSION}): "
+                                 f"{index_fn}")
+            header = json.loads(index_file.read(header_length))
+        data_start = -(-(len(preamble) + header_length) // _INDEX_ALIGNMENT) * _INDEX_ALIGNMENT
+
+        arrays = {}
+        for name, (offset, shape, dtype) in header['arrays'].items():
+            if np.prod(shape) == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)     # np.memmap cannot map empty arrays
+            else:
+                # Plain ndarray views of the mapping avoid the overhead of np.memmap indexing
+                arrays[name] = np.memmap(index_fn, dtype=dtype, mode='r', offset=data_start + offset,
+                                         shape=tuple(shape)).view(np.ndarray)
+        if verify:
+            checksum = 0
+            for array in arrays.values():
+                checksum = zlib.crc32(cls._padded_bytes(array), checksum)
+            if checksum != header['checksum']:
+                raise ValueError(f"Transcript index checksum mismatch, file may be corrupt: {index_fn}")
+
+        table = cls.__new__(cls)
+        table.path = index_fn
+        table.chroms = header['chroms']
+        table.tx_codes = _HashedTxCodes(arrays.pop('tx_id_offsets'), arrays.pop('tx_id_bytes'),
+                                        arrays.pop('tx_id_slots'))
+        for name, array in arrays.items():
+            setattr(table, name, array)
+        return table
+
+    def encode_tx_ids(self, tx_ids) -> np.ndarray:
+        """ Return array of transcript codes for the given transcript IDs, -1 for IDs not in the table """
+        return np.fromiter((self.tx_codes.get(tx_id, -1) for tx_id in tx_ids), dtype=np.int64, count=len(tx_ids))
+
+    def map_queries(self, tx_ids, tx_positions) -> (np.ndarray, np.ndarray, np.ndarray):
+        """ Translate a chunk of (0-based) transcript coordinates, each on its own transcript, to (0-based) genome
+        coordinates. Runs in O(Q log S) time for Q queries and S segments, entirely in NumPy apart from the transcript
+        ID lookup.
+
+        :param tx_ids: sequence of transcript IDs, one per query
+        :param tx_positions: sequence or array of integers representing query transcript coordinates
+        :return tuple of three arrays of the same length as tx_ids: int32 chromosome codes indexing self.chroms (-1
+            for unknown transcripts), int64 genomic coordinates (-1 where not mapped), and int8 MappingStatus codes
+        """
+        return self.map_codes(self.encode_tx_ids(tx_ids), tx_positions)
+
+    def map_codes(self, tx_codes, tx_positions) -> (np.ndarray, np.ndarray, np.ndarray):
+        """ Same as map_queries, with transcripts given by the codes returned by encode_tx_ids instead of their IDs.
+        Transcripts with more than one alignment are mapped using their primary alignment. """
+        return self.map_alignments(self.primary_alignments(tx_codes), tx_positions)
+
+    def map_all_hits(self, tx_codes, tx_positions) -> tuple:
+        """ Translate a chunk of (0-based) transcript coordinates to (0-based) genome coordinates on every alignment of
+        their transcripts, in one vectorized pass, giving one hit per query and alignment.
+
+        :param tx_codes: transcript codes returned by encode_tx_ids, one per query
+        :param tx_positions: sequence or array of integers representing query transcript coordinates
+        :return tuple of five arrays with one entry per hit, ordered by query and then alignment: int64 index of the
+            query in the input, int64 alignment index of the hit among the alignments of its transcript, and the
+            chromosome codes, genomic coordinates and MappingStatus codes of the hits as returned by map_queries.
+            Unknown transcripts give a single hit with status UNKNOWN_TX.
+        """
+        tx_positions = np.asarray(tx_positions, dtype=np.int64)
+        tx_codes = np.asarray(tx_codes, dtype=np.int64)
+        known = tx_codes >= 0
+        first_alignments = np.full(tx_codes.shape, -1, dtype=np.int64)
+        n_hits = np.ones(tx_codes.shape, dtype=np.int64)
+        first_alignments[known] = self.tx_alignment_offsets[tx_codes[known]]
+        n_hits[known] = self.tx_alignment_offsets[tx_codes[known] + 1] - first_alignments[known]
+
+        query_ix = np.repeat(np.arange(len(tx_codes)), n_hits)
+        alignment_ix = np.arange(len(query_ix)) - np.repeat(np.cumsum(n_hits) - n_hits, n_hits)
+        alignment_codes = np.where(known[query_ix], first_alignments[query_ix] + alignment_ix, -1)
+        return (query_ix, alignment_ix) + self.map_alignments(alignment_codes, tx_positions[query_ix])
+
+    def primary_alignments(self, tx_codes) -> np.ndarray:
+        """ Return array of the alignment codes of the primary alignments of the given transcript codes, -1 for -1 """
+        tx_codes = np.asarray(tx_codes, dtype=np.int64)
+        return np.where(tx_codes < 0, -1, self.tx_alignment_offsets[np.maximum(tx_codes, 0)])
+
+    def map_alignments(self, alignment_codes, tx_positions) -> (np.ndarray, np.ndarray, np.ndarray):
+        """ Same as map_queries, with each query mapped on the alignment with the given alignment code, -1 for queries
+        on unknown transcripts """
+        tx_positions = np.asarray(tx_positions, dtype=np.int64)
+        alignment_codes = np.array(alignment_codes, dtype=np.int64)
+        status = np.full(tx_positions.shape, MappingStatus.OK, dtype=np.int8)
+
+        unknown_tx = alignment_codes < 0
+        alignment_codes[unknown_tx] = 0
+        if not len(self):
+            alignment_codes[:] = -1
+            status[:] = MappingStatus.UNKNOWN_TX
+            return alignment_codes.astype(np.int32), np.full(tx_positions.shape, -1, dtype=np.int64), status
+
+        out_of_bounds = ~unknown_tx & ((tx_positions < 0) | (tx_positions >= self.tx_lengths[alignment_codes]))
+        not_mapped = unknown_tx | out_of_bounds
+
+        keys = self.tx_key_offsets[alignment_codes] + np.where(not_mapped, 0, tx_positions)
+        seg_ix = np.searchsorted(self.seg_keys, keys, side='right') - 1
+
+        # Positions within insertions take the genome coordinate of the segment, i.e. the next base along the transcript
+        in_insertion = ~_CONSUMES_GENOME[self.seg_ops[seg_ix]] & ~not_mapped
+        within_segment = np.where(in_insertion, 0, keys - self.seg_keys[seg_ix])
+        chrom_positions = self.seg_genome[seg_ix] + self.tx_strands[alignment_codes] * within_segment
+        chrom_codes = self.chrom_codes[alignment_codes]
+
+        chrom_positions[not_mapped] = -1
+        chrom_codes[unknown_tx] = -1
+        status[in_insertion] = MappingStatus.IN_INSERTION
+        status[out_of_bounds] = MappingStatus.OUT_OF_BOUNDS
+        status[unknown_tx] = MappingStatus.UNKNOWN_TX
+        return chrom_codes, chrom_positions, status
+
+    def map_intervals(self, tx_codes, tx_starts, tx_ends) -> tuple:
+        """ Translate a chunk of (0-based, half-open) transcript intervals [tx_start, tx_end), each on its own
+        transcript, to the genomic blocks they project onto, in one vectorized pass. Blocks are split and reported as
+        by CIGARString.map_interval, using the primary alignment of each transcript. Runs in O(Q log S + B) time for Q
+        queries, S segments and B blocks.
+
+        :param tx_codes: transcript codes returned by encode_tx_ids, one per query
+        :param tx_starts: sequence or array of integers representing the first transcript coordinate of each query
+        :param tx_ends: sequence or array of integers representing the end (exclusive) of each query
+        :return tuple of seven arrays with one entry per block, ordered by query and then transcript coordinate: int64
+            index of the query in the input, int32 chromosome codes indexing self.chroms (-1 for unknown transcripts),
+            int64 transcript start and end of the block, int64 genomic start and end of the block (-1 where not
+            mapped), and int8 MappingStatus codes. Queries that cannot be mapped give a single block with the
+            transcript interval of the query and status UNKNOWN_TX or OUT_OF_BOUNDS.
+        """
+        tx_starts = np.asarray(tx_starts, dtype=np.int64)
+        tx_ends = np.asarray(tx_ends, dtype=np.int64)
+        tx_codes = self.primary_alignments(tx_codes)        # intervals are mapped on primary alignments
+
+        unknown_tx = tx_codes < 0
+        tx_codes[unknown_tx] = 0
+        if not len(self):
+            no_blocks = np.full(tx_starts.shape, -1, dtype=np.int64)
+            return (np.arange(len(tx_starts)), no_blocks.astype(np.int32), tx_starts, tx_ends, no_blocks, no_blocks,
+                    np.full(tx_starts.shape, MappingStatus.UNKNOWN_TX, dtype=np.int8))
+
+        out_of_bounds = ~unknown_tx & ((tx_starts < 0) | (tx_ends > self.tx_lengths[tx_codes]) | (tx_starts >= tx_ends))
+        not_mapped = unknown_tx | out_of_bounds
+
+        # Queries that are not mapped span a single segment of the first transcript
+        tx_offsets = self.tx_key_offsets[tx_codes]
+        key_starts = tx_offsets + np.where(not_mapped, 0, tx_starts)
+        key_ends = np.where(not_mapped, key_starts + 1, tx_offsets + tx_ends)
+        first = np.searchsorted(self.seg_keys, key_starts, side='right') - 1
+        n_segs = np.searchsorted(self.seg_keys, key_ends - 1, side='right') - first
+
+        # Expand each query into the segments it overlaps, clipped to the query interval. Segments that do not consume
+        # transcript bases are empty in key space and drop out, splitting the blocks on either side of them.
+        seg_query = np.repeat(np.arange(len(key_starts)), n_segs)
+        seg_ix = np.repeat(first - np.cumsum(n_segs) + n_segs, n_segs) + np.arange(len(seg_query))
+        next_ix = np.minimum(seg_ix + 1, len(self.seg_keys) - 1)
+        seg_key_ends = np.where(seg_ix + 1 < len(self.seg_keys), self.seg_keys[next_ix],
+                                self.tx_key_offsets[-1] + self.tx_lengths[-1])
+        block_key_starts = np.maximum(key_starts[seg_query], self.seg_keys[seg_ix])
+        block_key_ends = np.minimum(key_ends[seg_query], seg_key_ends)
+        keep = (block_key_ends > block_key_starts) | not_mapped[seg_query]
+        seg_query, seg_ix = seg_query[keep], seg_ix[keep]
+        block_key_starts, block_key_ends = block_key_starts[keep], block_key_ends[keep]
+
+        # On the minus strand, a block ends (on the genome) where its first transcript base is, and insertions lie to
+        # the right of the genome offset of their segment
+        in_insertion = ~_CONSUMES_GENOME[self.seg_ops[seg_ix]]
+        minus_strand = self.tx_strands[tx_codes[seg_query]] < 0
+        block_lengths = np.where(in_insertion, 0, block_key_ends - block_key_starts)
+        first_base = self.seg_genome[seg_ix] + np.where(in_insertion, minus_strand,
+                                                        np.where(minus_strand, -1, 1) *
+                                                        (block_key_starts - self.seg_keys[seg_ix]))
+        chrom_starts = np.where(minus_strand & ~in_insertion, first_base - block_lengths + 1, first_base)
+        chrom_ends = chrom_starts + block_lengths
+        status = np.where(in_insertion, MappingStatus.IN_INSERTION, MappingStatus.OK).astype(np.int8)
+        status[out_of_bounds[seg_query]] = MappingStatus.OUT_OF_BOUNDS
+        status[unknown_tx[seg_query]] = MappingStatus.UNKNOWN_TX
+
+        # Merge adjacent blocks of the same query and kind, e.g. those of '5M0D5M' or '2I3I'
+        merged = np.zeros(len(seg_query), dtype=bool)
+        merged[1:] = ((seg_query[1:] == seg_query[:-1]) & (status[1:] == status[:-1]) &
+                      (status[1:] <= MappingStatus.IN_INSERTION) &
+                      np.where(minus_strand[1:], chrom_ends[1:] == chrom_starts[:-1],
+                               chrom_starts[1:] == chrom_ends[:-1]))
+        block_firsts = np.flatnonzero(~merged)
+        block_lasts = np.append(block_firsts[1:], len(seg_query)) - 1
+        block_minus_strand = minus_strand[block_firsts]
+
+        query_ix = seg_query[block_firsts]
+        block_tx_offsets = tx_offsets[query_ix]
+        block_tx_starts = np.where(not_mapped[query_ix], tx_starts[query_ix],
+                                   block_key_starts[block_firsts] - block_tx_offsets)
+        block_tx_ends = np.where(not_mapped[query_ix], tx_ends[query_ix],
+                                 block_key_ends[block_lasts] - block_tx_offsets)
+        chrom_codes = self.chrom_codes[tx_codes[query_ix]]
+        chrom_starts, chrom_ends = (np.where(block_minus_strand, chrom_starts[block_lasts], chrom_starts[block_firsts]),
+                                    np.where(block_minus_strand, chrom_ends[block_firsts], chrom_ends[block_lasts]))
+        status = status[block_firsts]
+
+        block_not_mapped = not_mapped[query_ix]
+        chrom_starts[block_not_mapped] = -1
+        chrom_ends[block_not_mapped] = -1
+        chrom_codes[unknown_tx[query_ix]] = -1
+        return query_ix, chrom_codes, block_tx_starts, block_tx_ends, chrom_starts, chrom_ends, status
+
+
+class GenomeIntervalIndex:
+    """ Per-chromosome index of the aligned blocks (match regions) of all transcripts in a SegmentTable, answering which
+    transcripts, and which transcript coordinates, cover a genome position.
+
+    Blocks are binned by length class, floor(log2(length)), and stored as struct of NumPy arrays sorted by length
+    class, chromosome and start. Starts are addressed by a global key chrom_key_offsets[chrom_code] + chrom_pos, so
+    that a whole chunk of positions is looked up with np.searchsorted in each length class. A block covering position p
+    must start within the longest block length L of its class before p. Blocks of that class starting in this window
+    that do not cover p are at least L / 2 long, and so cover position p - L / 2; each lookup thus takes
+    O(c log n + k + d) time for n blocks in c length classes, k hits and d blocks covering the positions L / 2 before p.
+    Unlike a single window of the longest block length on each chromosome, one long block does not make every lookup
+    on its chromosome scan all blocks near it.
+    """
+    def __init__(self, segment_table: SegmentTable, all_alignments: bool = False):
+        """
+        :param segment_table: SegmentTable whose transcripts are indexed; transcript codes follow its codes
+        :param all_alignments: if True, index the blocks of every alignment of each transcript, numbered by the
+            alignment_ix returned by query_many, rather than only those of its primary (first) alignment, so that a
+            transcript aligned to a position once is reported once
+        """
+        self.tx_ids = list(segment_table.tx_codes)
+        self.chroms = list(segment_table.chroms)
+        self._chrom_codes = {chrom_id: code for code, chrom_id in enumerate(self.chroms)}
+
+        # A segment ends where the next one starts, in key space; aligned blocks advance genome and transcript alike
+        seg_key_ends = np.append(segment_table.seg_keys[1:], segment_table.tx_lengths.sum())
+        block_lengths = seg_key_ends - segment_table.seg_keys
+        is_block = (_CONSUMES_TX & _CONSUMES_GENOME)[segment_table.seg_ops] & (block_lengths > 0)
+        alignment_tx = np.repeat(np.arange(len(segment_table), dtype=np.int32),
+                                 np.diff(segment_table.tx_alignment_offsets))
+        alignment_ix = np.arange(len(alignment_tx)) - segment_table.tx_alignment_offsets[alignment_tx]
+        if not all_alignments:
+            is_block &= alignment_ix[segment_table.seg_tx] == 0
+
+        block_alignments = segment_table.seg_tx[is_block]
+        block_chroms = segment_table.chrom_codes[block_alignments]
+        block_lengths = block_lengths[is_block]
+        block_tx_starts = segment_table.seg_keys[is_block] - segment_table.tx_key_offsets[block_alignments]
+        block_starts = segment_table.seg_genome[is_block]
+        block_tx = alignment_tx[block_alignments]
+        block_alignment_ix = alignment_ix[block_alignments]
+
+        # Segments of minus-strand transcripts start at their last genome base; turn them around so that every block
+        # starts at its first genome base, and block_tx_starts is the transcript coordinate aligned to that base
+        block_strands = segment_table.tx_strands[block_alignments]
+        minus_strand = block_strands < 0
+        block_starts = np.where(minus_strand, block_starts - block_lengths + 1, block_starts)
+        block_tx_starts = np.where(minus_strand, block_tx_starts + block_lengths - 1, block_tx_starts)
+
+        n_chroms = len(self.chroms)
+        chrom_spans = np.zeros(n_chroms, dtype=np.int64)
+        np.maximum.at(chrom_spans, block_chroms, block_starts + block_lengths)
+        self.chrom_key_offsets = np.zeros(n_chroms + 1, dtype=np.int64)
+        np.cumsum(chrom_spans + 1, out=self.chrom_key_offsets[1:])
+        block_keys = self.chrom_key_offsets[block_chroms] + block_starts
+
+        # Hits of a query are output in order of block key, which block_ranks keeps across length classes
+        block_ranks = np.empty(len(block_keys), dtype=np.int64)
+        block_ranks[np.lexsort((block_starts, block_chroms))] = np.arange(len(block_keys))
+        block_classes = np.frexp(block_lengths.astype(np.float64))[1] - 1
+        order = np.lexsort((block_ranks, block_classes))
+
+        self.block_keys = block_keys[order]
+        self.block_ranks = block_ranks[order]
+        self.block_starts = block_starts[order]
+        self.block_ends = self.block_starts + block_lengths[order]
+        self.block_tx = block_tx[order]
+        self.block_alignment_ix = block_alignment_ix[order]
+        self.block_tx_starts = block_tx_starts[order]
+        self.block_strands = block_strands[order]
+
+        # Offsets of the blocks of each non-empty length class, and the longest block length in each
+        block_classes = block_classes[order]
+        class_starts = np.flatnonzero(np.diff(block_classes, prepend=-1))
+        self.class_block_offsets = np.append(class_starts, len(block_classes))
+        self.class_max_lengths = np.maximum.reduceat(block_lengths[order], class_starts) if len(class_starts) else \
+            np.zeros(0, dtype=np.int64)
+
+    def query(self, chrom_id: str, chrom_pos: int) -> list:
+        """ Return list of (tx_id, tx_pos, alignment_ix) tuples of all indexed transcript alignments aligned to genome
+        coordinate chrom_id:chrom_pos """
+        _, tx_codes, tx_positions, alignment_ix = self.query_many([chrom_id], [chrom_pos])
+        return [(self.tx_ids[tx_code], tx_pos, ix)
+                for tx_code, tx_pos, ix in zip(tx_codes.tolist(), tx_positions.tolist(), alignment_ix.tolist())]
+
+    def query_many(self, chrom_ids, chrom_positions) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+        """ Find all transcripts aligned to each of a chunk of (0-based) genome coordinates, in one vectorized pass per
+        length class of blocks. Candidate blocks are expanded for at most _INTERVAL_CANDIDATE_LIMIT at a time, apart
+        from queries that have more candidates on their own.
+
+        :param chrom_ids: sequence of chromosome IDs, one per query
+        :param chrom_positions: sequence or array of integers representing query genomic coordinates
+        :return tuple of four arrays with one entry per hit, ordered by query: int64 index of the query in the input,
+            int32 transcript codes indexing self.tx_ids, int64 transcript coordinates, and int64 indices of the
+            alignments of the transcripts, numbered from 0 in the order of the transcripts file
+        """
+        chrom_positions = np.asarray(chrom_positions, dtype=np.int64)
+        chrom_codes = np.fromiter((self._chrom_codes.get(chrom_id, -1) for chrom_id in chrom_ids), dtype=np.int64,
+                                  count=len(chrom_ids))
+        known = chrom_codes >= 0
+        query_ix = np.flatnonzero(known)
+        chrom_codes, chrom_positions = chrom_codes[known], chrom_positions[known]
+
+        # Candidate blocks of each length class start in [chrom_pos - max block length + 1, chrom_pos], clipped to the
+        # keys of the chromosome: one row of first and last candidate block per length class, one column per query
+        keys = self.chrom_key_offsets[chrom_codes] + chrom_positions
+        chrom_first_keys = self.chrom_key_offsets[chrom_codes]
+        chrom_last_keys = self.chrom_key_offsets[chrom_codes + 1] - 1
+        n_classes = len(self.class_max_lengths)
+        first = np.empty((n_classes, len(keys)), dtype=np.int64)
+        last = np.empty((n_classes, len(keys)), dtype=np.int64)
+        for class_ix in range(n_classes):
+            class_start, class_end = self.class_block_offsets[class_ix:class_ix + 2]
+            class_keys = self.block_keys[class_start:class_end]
+            first_keys = np.maximum(keys - self.class_max_lengths[class_ix] + 1, chrom_first_keys)
+            first[class_ix] = class_start + np.searchsorted(class_keys, first_keys, side='left')
+            last[class_ix] = class_start + np.searchsorted(class_keys, np.minimum(keys, chrom_last_keys), side='right')
+        n_candidates = np.maximum(last - first, 0)
+
+        # Split queries into batches of at most _INTERVAL_CANDIDATE_LIMIT candidates, each at least one query
+        candidate_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(n_candidates.sum(axis=0), out=candidate_offsets[1:])
+        hit_queries, hit_blocks = [], []
+        batch_start = 0
+        while batch_start < len(keys):
+            batch_end = np.searchsorted(candidate_offsets, candidate_offsets[batch_start] + _INTERVAL_CANDIDATE_LIMIT,
+                                        side='right') - 1
+            batch_end = max(batch_end, batch_start + 1)
+
+            # Expand each query into its candidate blocks, and keep those that extend past the query position
+            batch_first = first[:, batch_start:batch_end].ravel()
+            batch_n_candidates = n_candidates[:, batch_start:batch_end].ravel()
+            candidate_query = np.repeat(np.tile(np.arange(batch_start, batch_end), n_classes), batch_n_candidates)
+            candidate_block = np.repeat(batch_first - np.cumsum(batch_n_candidates) + batch_n_candidates,
+                                        batch_n_candidates) + np.arange(len(candidate_query))
+            hit = self.block_ends[candidate_block] > chrom_positions[candidate_query]
+            hit_queries.append(candidate_query[hit])
+            hit_blocks.append(candidate_block[hit])
+            batch_start = batch_end
+
+        hit_query = np.concatenate(hit_queries) if hit_queries else np.zeros(0, dtype=np.int64)
+        hit_block = np.concatenate(hit_blocks) if hit_blocks else np.zeros(0, dtype=np.int64)
+        order = np.lexsort((self.block_ranks[hit_block], hit_query))
+        hit_query, hit_block = hit_query[order], hit_block[order]
+
+        tx_positions = self.block_tx_starts[hit_block] + \
+            self.block_strands[hit_block] * (chrom_positions[hit_query] - self.block_starts[hit_block])
+        return query_ix[hit_query], self.block_tx[hit_block], tx_positions, self.block_alignment_ix[hit_block]
+
+
+class BGZFWriter:
+    """ Binary output file compressed as BGZF, the blocked gzip format of htslib, which any gzip reader can decompress.
+    Written data is split into blocks that are compressed by a pool of threads, as zlib releases the GIL while
+    compressing, so that compression runs on several cores and overlaps with producing further output. Compressed
+    blocks are written in order. Use as a context manager so that remaining blocks and the end-of-file marker are
+    written on exit.
+    """
+    def __init__(self, fn, threads: int = None, level: int = 6):
+        """
+        :param fn: filepath to output file
+        :param threads: number of compression threads, by default the number of CPUs
+        :param level: zlib compression level
+        """
+        import concurrent.futures     # imported here, as it is only needed for compressed output
+        self.threads = threads or os.cpu_count() or 1
+        self.level = level
+        self.out_file = open(fn, 'wb')
+        self._pool = concurrent.futures.ThreadPoolExecutor(self.threads)
+        self._pending = collections.deque()     # futures of compressed blocks not written yet, in output order
+
+    @staticmethod
+    def compress_block(data, level: int = 6) -> bytes:
+        """ Return BGZF block holding data, at most _BGZF_BLOCK_SIZE bytes, compressed with raw deflate """
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        # gzip header with the 'BC' extra subfield holding the total block size - 1, and gzip footer
+        header = _BGZF_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2,
+                                   _BGZF_HEADER.size + len(compressed) + 7)
+        return header + compressed + struct.pack('<II', zlib.crc32(data), len(data))
+
+    def write(self, data: bytes):
+        """ Queue data for compression, and write the blocks compressed so far. Waits for the oldest blocks while more
+        than 4 blocks per thread are pending, which bounds memory use if output is produced faster than compressed. """
+        view = memoryview(data)
+        for start in range(0, len(data), _BGZF_BLOCK_SIZE):
+            self._pending.append(self._pool.submit(self.compress_block, view[start:start + _BGZF_BLOCK_SIZE],
+                                                   self.level))
+        while self._pending and (self._pending[0].done() or len(self._pending) > 4 * self.threads):
+            self.out_file.write(self._pending.popleft().result())
+
+    def close(self):
+        """ Write all remaining blocks and the end-of-file marker, and close the file """
+        while self._pending:
+            self.out_file.write(self._pending.popleft().result())
+        self.out_file.write(_BGZF_EOF)
+        self._pool.shutdown()
+        self.out_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ResultWriter:
+    """ Buffered writer that formats whole chunks of mapping results as tab-delimited lines. Formatted chunks are kept
+    in memory until at least buffer_size bytes are pending, and then written to the output file with a single write
+    call. Use as a context manager so that remaining output is flushed on exit.
+    """
+    def __init__(self, out_file, buffer_size: int = _WRITE_BUFFER_SIZE):
+        """
+        :param out_file: output file opened in binary mode
+        :param buffer_size: number of bytes of formatted output to collect before writing
+        """
+        self.out_file = out_file
+        self.buffer_size = buffer_size
+        self._pending = []
+        self._pending_size = 0
+
+    @staticmethod
+    def format(*columns) -> bytes:
+        """ Format a chunk of output lines, given as columns of equal length. Columns are lists of strings or arrays of
+        integers. """
+        if not len(columns[0]):
+            return b''
+        columns = [map(str, column.tolist()) if isinstance(column, np.ndarray) else column for column in columns]
+        return ('\n'.join(map('\t'.join, zip(*columns))) + '\n').encode()
+
+    def write(self, *columns):
+        """ Format and buffer a chunk of output lines, given as columns of equal length """
+        self.write_formatted(self.format(*columns))
+
+    def write_formatted(self, formatted: bytes):
+        """ Buffer a chunk of output lines already formatted by ResultWriter.format """
+        self._pending.append(formatted)
+        self._pending_size += len(formatted)
+        if self._pending_size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """ Write all buffered output """
+        if self._pending:
+            self.out_file.write(b''.join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+
+class ArrowResultWriter:
+    """ Writer of mapping results to a Parquet or Arrow IPC file, with the interface of ResultWriter. Each chunk of
+    output lines is converted from its columns to one record batch (a row group in Parquet), without formatting them
+    as text. Columns named '*_id' and the status column are strings, and all others int64. pyarrow is only imported
+    when this is created.
+    """
+    def __init__(self, output_fn, column_names, output_format: str = 'parquet'):
+        """
+        :param output_fn: filepath to output file
+        :param column_names: names of the output columns
+        :param output_format: 'parquet' or 'arrow' (Arrow IPC file format)
+        """
+        import pyarrow     # imported here, as it is an optional dependency only needed for Parquet and Arrow files
+        self._pyarrow = pyarrow
+        self.schema = pyarrow.schema([(name, pyarrow.string() if name.endswith('_id') or name == 'status'
+                                       else pyarrow.int64()) for name in column_names])
+        if output_format == 'parquet':
+            import pyarrow.parquet
+            self._writer = pyarrow.parquet.ParquetWriter(output_fn, self.schema)
+        else:
+            self._writer = pyarrow.ipc.new_file(output_fn, self.schema)
+
+    @staticmethod
+    def format(*columns) -> tuple:
+        """ Return a chunk of output lines, given as columns of equal length, as they are written by write_formatted.
+        Columns are lists of strings or arrays of integers, as for ResultWriter.format. """
+        return columns
+
+    def write(self, *columns):
+        """ Write a chunk of output lines, given as columns of equal length """
+        self.write_formatted(self.format(*columns))
+
+    def write_formatted(self, formatted: tuple):
+        """ Write a chunk of output lines returned by ArrowResultWriter.format as a record batch """
+        if len(formatted[0]):
+            arrays = [self._pyarrow.array(column, type=field.type) for column, field in zip(formatted, self.schema)]
+            self._writer.write_batch(self._pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def flush(self):
+        """ Nothing to flush, as chunks are written as they come """
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc_info):
+        self._writer.close()
 
-def run(transcripts_fn, queries_fn, output_fn):
+
+@contextlib.contextmanager
+def _open_result_writer(output_fn, column_names, write_buffer_size=_WRITE_BUFFER_SIZE, output_format='tsv',
+                        compress=False, compress_threads=None):
+    """Open output file and return ResultWriter writing tab-delimited lines to it, compressed if compress is True, or
+    ArrowResultWriter if output_format is 'parquet' or 'arrow'
+
+    :raises ValueError: if output_format is unknown, or compress is True with a columnar output format
+    """
+    if output_format not in _OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format, expecting one of {', '.join(_OUTPUT_FORMATS)} (output_format = "
+                         f"{output_format})")
+    if output_format == 'tsv':
+        with _open_output(output_fn, compress, compress_threads) as out_file, \
+                ResultWriter(out_file, write_buffer_size) as writer:
+            yield writer
+    elif compress:
+        raise ValueError(f"Compressing output needs tab-delimited output, {output_format} files are compressed by "
+                         f"pyarrow")
+    else:
+        with ArrowResultWriter(output_fn, column_names, output_format) as writer:
+            yield writer
+
+
+def run(transcripts_fn, queries_fn, output_fn, cigar_cache_size=_CIGAR_CACHE_SIZE, group_by_tx=False,
+        chunk_size=_QUERY_CHUNK_SIZE, write_buffer_size=_WRITE_BUFFER_SIZE, workers=1, verify_index=False,
+        all_hits=False, sam_filter=SAMFilter(), compress=False, compress_threads=None, output_format='tsv',
+        status_column=False):
     """Read input files containing transcript mappings and query transcript coordinates, and output file containing
     coordinates that have been mapped to chromosome coordinates. All coordinates are 0-based.
     Assumptions: input files are correctly formatted.
 
     :param transcripts_fn: filepath to tab-delimited input file containing list of transcripts and their genomic
-        mapping. Columns are [tx_id, chrom_id, mapping_start_pos, CIGAR_str], and the file contains no header.
+        mapping. Columns are [tx_id, chrom_id, mapping_start_pos, CIGAR_str], optionally followed by [strand], and
+        the file contains no header; the same columns can be read from a Parquet or Arrow IPC file, detected by its
+        magic bytes (see TranscriptIndex.load_columnar). Alternatively, filepath to a GTF or GFF3 annotation file (see
+        TranscriptIndex.load_annotation), to a SAM file of transcript alignments (see TranscriptIndex.load_sam), or to
+        a binary index file written by build_index, which is memory-mapped
     :param queries_fn: filepath to tab-delimited input file containing list of queries with transcript coordinates.
-        Columns are [tx_id, tx_pos], and the file contains no header.
+        Columns are [tx_id, tx_pos], and the file contains no header. Alternatively, filepath to a Parquet or Arrow
+        IPC file whose first two columns are these, whatever their names
     :param output_fn: filepath to output file. Contains the following columns: [tx_id, tx_pos, chrom_id, chrom_pos]
-    :raises ValueError: if error parsing input file, e.g. unexpected number of columns
+    :param cigar_cache_size: maximum number of distinct parsed CIGAR strings kept while loading transcripts
+    :param group_by_tx: if True, map each chunk of queries by grouping them by transcript and mapping each group
+        against its own CIGAR, rather than in one pass over a SegmentTable of all transcripts
+    :param chunk_size: number of queries read, mapped and written at a time, which bounds memory use independent of
+        the size of the queries file
+    :param write_buffer_size: number of bytes of formatted output collected before each write to the output file
+    :param workers: number of worker processes parsing, mapping and formatting chunks of queries. With more than 1
+        worker, blocks of lines of the queries file are handed to a process pool (see _run_in_pool), and results are
+        written back in input order
+    :param verify_index: if transcripts_fn is a binary index file, check its checksum before mapping
+    :param all_hits: if True, map each query on every alignment of its transcript rather than only the first one, and
+        output one line per alignment, with the columns [tx_id, tx_pos, alignment_ix, chrom_id, chrom_pos], where
+        alignment_ix numbers the alignments of each transcript in the order of the transcripts file, from 0
+    :param sam_filter: SAMFilter selecting the records loaded if transcripts_fn is a SAM file
+    :param compress: if True, write output compressed as BGZF (see BGZFWriter)
+    :param compress_threads: number of threads compressing output, by default the number of CPUs
+    :param output_format: 'tsv' for tab-delimited output, or 'parquet' or 'arrow' to write the output columns to a
+        Parquet or Arrow IPC file with ArrowResultWriter
+    :param status_column: if True, add a status column with the name of the MappingStatus of each output line, and
+        output queries that cannot be mapped, with chrom_pos -1 (and chrom_id '*' for unknown transcripts), instead of
+        raising on them. The number of queries with each status is reported at the end in any case
+    :raises KeyError: if a query transcript was not found in the transcript mappings, unless status_column is True
+    :raises ValueError: if error parsing input file, e.g. unexpected number of columns, if a query transcript
+        coordinate is out-of-bounds, unless status_column is True, or if both group_by_tx and all_hits are True
     """
+    if group_by_tx and all_hits:
+        raise ValueError("Mapping queries on all alignments needs the segment table, not grouping by transcript")
+
+    mapper = _open_transcripts(transcripts_fn, cigar_cache_size, verify_index, group_by_tx, sam_filter)
 
-    # Read transcripts file
-    df_transcripts = pd.read_csv(transcripts_fn, delimiter='\t', index_col=0, header=None,
-                              names=['tx_id', 'chrom_id', 'mapping_start_pos', 'CIGAR_str'])
+    # Stream queries file in chunks, mapping each chunk in a single pass over the segment table, or one pass per
+    # transcript if grouping queries by transcript
+    column_names = ['tx_id', 'tx_pos'] + (['alignment_ix'] if all_hits else []) + ['chrom_id', 'chrom_pos']
+    column_names += ['status'] if status_column else []
+    status_counts = np.zeros(len(MappingStatus), dtype=np.int64)
+    with _open_result_writer(output_fn, column_names, write_buffer_size, output_format, compress,
+                             compress_threads) as writer:
+        if workers > 1:
+            _run_in_pool(mapper, _read_query_blocks(queries_fn, chunk_size), writer, workers, all_hits, status_column,
+                         status_counts)
+        else:
+            chrom_ids = _chrom_id_array(mapper.chroms)
+            for tx_ids, tx_positions in _read_query_file(queries_fn, chunk_size):
+                status, query_ix, formatted = _map_and_format_chunk(mapper, chrom_ids, tx_ids, tx_positions,
+                                                                    all_hits=all_hits, format_chunk=writer.format,
+                                                                    status_column=status_column)
+                _check_mapping_status(tx_ids, tx_positions, status, query_ix, status_counts, status_column)
+                writer.write_formatted(formatted)
+    print(f'Mappings done, output to {output_fn}')
+    _report_status_counts(status_counts)
+
+
+def run_genome_queries(transcripts_fn, queries_fn, output_fn, cigar_cache_size=_CIGAR_CACHE_SIZE,
+                       chunk_size=_QUERY_CHUNK_SIZE, write_buffer_size=_WRITE_BUFFER_SIZE, verify_index=False,
+                       sam_filter=SAMFilter(), compress=False, compress_threads=None, output_format='tsv',
+                       all_hits=False):
+    """Read input files containing transcript mappings and query genome coordinates, and output file containing, for
+    each query, every transcript coordinate aligned to it. All coordinates are 0-based. Queries not covered by any
+    transcript produce no output. Only the primary (first) alignment of each transcript is searched, unless all_hits
+    is True.
 
-    # Read each line in queries file and output mappings line-by-line
-    with open(output_fn, 'w') as out_file:
-        with open(queries_fn, 'r') as queries_file:
+    :param transcripts_fn: filepath to transcripts file or binary index file, as for run()
+    :param queries_fn: filepath to tab-delimited input file containing list of queries with genome coordinates.
+        Columns are [chrom_id, chrom_pos], and the file contains no header, or a Parquet or Arrow IPC file, as for
+        run()
+    :param output_fn: filepath to output file. Contains the following columns: [chrom_id, chrom_pos, tx_id, tx_pos],
+        followed by [alignment_ix] if all_hits is True
+    :param cigar_cache_size, chunk_size, write_buffer_size, verify_index, sam_filter, compress, compress_threads,
+        output_format: as for run()
+    :param all_hits: if True, search every alignment of each transcript, and output the alignment_ix of each hit, as
+        numbered by run(), so that hits of several alignments of a transcript at the same position are told apart
+    """
+    intervals = GenomeIntervalIndex(_open_transcripts(transcripts_fn, cigar_cache_size, verify_index,
+                                                    sam_filter=sam_filter), all_hits)
+    tx_ids = np.array(intervals.tx_ids, dtype=object)
 
-            for line in queries_file:
-                try:
-                    tx_id, tx_pos = line.strip().split('\t')
-                except ValueError:
-                    print(f"Error parsing query file, expecting 2 values, check formatting in line: {line}")
-                    raise
-                chrom_id, chrom_pos = get_coordinate_mapping(tx_id, int(tx_pos), df_transcripts)
-                out_file.write('\t'.join([tx_id, str(tx_pos), chrom_id, str(chrom_pos)]) + '\n')
+    column_names = ['chrom_id', 'chrom_pos', 'tx_id', 'tx_pos'] + (['alignment_ix'] if all_hits else [])
+    with _open_result_writer(output_fn, column_names, write_buffer_size, output_format, compress,
+                             compress_threads) as writer:
+        for chrom_ids, chrom_positions in _read_query_file(queries_fn, chunk_size):
+            query_ix, tx_codes, tx_positions, alignment_ix = intervals.query_many(chrom_ids, chrom_positions)
+            columns = [np.array(chrom_ids, dtype=object)[query_ix].tolist(), chrom_positions[query_ix],
+                       tx_ids[tx_codes].tolist(), tx_positions]
+            writer.write(*columns + ([alignment_ix] if all_hits else []))
     print(f'Mappings done, output to {output_fn}')
 
 
-def get_coordinate_mapping(tx_id: str, tx_pos: int, df_transcripts: pd.DataFrame) -> (str, int):
-    """Find query transcript in df_transcripts and return its mapping to genomic coordinates.
-    Assumptions: each tx_id maps to a single chromosome, i.e. tx_id occurs at most once in df_transcripts.
+def run_interval_queries(transcripts_fn, queries_fn, output_fn, cigar_cache_size=_CIGAR_CACHE_SIZE,
+                         chunk_size=_QUERY_CHUNK_SIZE, write_buffer_size=_WRITE_BUFFER_SIZE, verify_index=False,
+                         sam_filter=SAMFilter(), compress=False, compress_threads=None, output_format='tsv',
+                         status_column=False):
+    """Read input files containing transcript mappings and query transcript intervals, and output file containing the
+    genomic blocks that each interval maps to. All coordinates are 0-based, and intervals are half-open.
+
+    :param transcripts_fn: filepath to transcripts file or binary index file, as for run()
+    :param queries_fn: filepath to tab-delimited input file containing list of queries with transcript intervals.
+        Columns are [tx_id, tx_start, tx_end], and the file contains no header, or a Parquet or Arrow IPC file, as
+        for run()
+    :param output_fn: filepath to output file. Contains one line per block, with the following columns: [tx_id,
+        tx_start, tx_end, chrom_id, chrom_start, chrom_end], where [tx_start, tx_end) is the part of the query interval
+        in the block. Parts that fall in insertions have chrom_start == chrom_end, at the base to the right.
+    :param cigar_cache_size, chunk_size, write_buffer_size, verify_index, sam_filter, compress, compress_threads,
+        output_format: as for run()
+    :param status_column: if True, add a status column with the name of the MappingStatus of each block, and output
+        queries that cannot be mapped as a single block with chrom_start and chrom_end -1, as for run()
+    :raises KeyError: if a query transcript was not found in the transcript mappings, unless status_column is True
+    :raises ValueError: if a query interval is empty or out-of-bounds, unless status_column is True
+    """
+    table = _open_transcripts(transcripts_fn, cigar_cache_size, verify_index, sam_filter=sam_filter)
+    chrom_ids = _chrom_id_array(table.chroms)
+
+    column_names = ['tx_id', 'tx_start', 'tx_end', 'chrom_id', 'chrom_start', 'chrom_end']
+    column_names += ['status'] if status_column else []
+    status_counts = np.zeros(len(MappingStatus), dtype=np.int64)
+    with _open_result_writer(output_fn, column_names, write_buffer_size, output_format, compress,
+                             compress_threads) as writer:
+        for tx_ids, tx_starts, tx_ends in _read_query_file(queries_fn, chunk_size, n_columns=3):
+            query_ix, chrom_codes, block_tx_starts, block_tx_ends, chrom_starts, chrom_ends, status = \
+                table.map_intervals(table.encode_tx_ids(tx_ids), tx_starts, tx_ends)
+            block_tx_ids = np.array(tx_ids, dtype=object)[query_ix]
+            _check_mapping_status(block_tx_ids, block_tx_starts, status, None, status_counts, status_column)
+            columns = [block_tx_ids.tolist(), block_tx_starts, block_tx_ends, chrom_ids[chrom_codes].tolist(),
+                       chrom_starts, chrom_ends]
+            writer.write(*columns, *([_STATUS_NAMES[status].tolist()] if status_column else []))
+    print(f'Mappings done, output to {output_fn}')
+    _report_status_counts(status_counts, 'blocks')
+
+
+def _open_transcripts(transcripts_fn, cigar_cache_size=_CIGAR_CACHE_SIZE, verify_index=False, group_by_tx=False,
+                      sam_filter=SAMFilter()):
+    """Open binary index file, or read transcripts file, and return SegmentTable, or the TranscriptIndex itself if
+    group_by_tx is True.
+
+    :raises ValueError: if group_by_tx is True and transcripts_fn is a binary index file
+    """
+    if SegmentTable.is_index_file(transcripts_fn):
+        if group_by_tx:
+            raise ValueError("Grouping queries by transcript needs a transcripts text file, not a binary index")
+        table = SegmentTable.open(transcripts_fn, verify_index)
+        print(f'Opened index of {len(table)} transcripts')
+        return table
+
+    transcripts = TranscriptIndex.load_any(transcripts_fn, cigar_cache_size, sam_filter)
+    print(f'Loaded {len(transcripts)} transcripts, CIGAR cache: {transcripts.cigar_cache}')
+    return transcripts if group_by_tx else SegmentTable(transcripts)
+
+
+def build_index(transcripts_fn, index_fn, cigar_cache_size=_CIGAR_CACHE_SIZE, sam_filter=SAMFilter()):
+    """Read transcripts file and write its mappings to a binary index file, which run() memory-maps instead of parsing
+    the transcripts file again.
+
+    :param transcripts_fn: filepath to tab-delimited input file containing list of transcripts and their genomic
+        mapping, or to GTF, GFF3 or SAM file, as for run()
+    :param index_fn: filepath to output binary index file
+    :param cigar_cache_size: maximum number of distinct parsed CIGAR strings kept while loading transcripts
+    :param sam_filter: SAMFilter selecting the records loaded if transcripts_fn is a SAM file
+    """
+    transcripts = TranscriptIndex.load_any(transcripts_fn, cigar_cache_size, sam_filter)
+    SegmentTable(transcripts).save(index_fn)
+    print(f'Index of {len(transcripts)} transcripts written to {index_fn}')
+
+
+def _map_and_format_chunk(mapper, chrom_ids: np.ndarray, tx_ids, tx_positions, tx_codes=None, all_hits=False,
+                          format_chunk=ResultWriter.format, status_column=False) -> (np.ndarray, np.ndarray, bytes):
+    """Map a chunk of queries and format the output lines for it.
+
+    :param mapper: SegmentTable or TranscriptIndex used to map the queries
+    :param chrom_ids: object array of chromosome IDs returned by _chrom_id_array, indexed by the chromosome codes of
+        mapper
+    :param tx_codes: optional transcript codes already encoded by a SegmentTable, used instead of tx_ids for mapping
+    :param all_hits: if True, map each query on all alignments of its transcript with SegmentTable.map_all_hits
+    :param format_chunk: format function of the writer the output lines are written to, ResultWriter.format or
+        ArrowResultWriter.format
+    :param status_column: if True, add a column with the MappingStatus name of each output line
+    :return tuple containing the array of MappingStatus codes, the array of the query index of each output line if
+        all_hits is True and None otherwise, and the formatted output lines
+    """
+    if tx_codes is None:
+        tx_codes = mapper.encode_tx_ids(tx_ids) if all_hits else None
+    if all_hits:
+        query_ix, alignment_ix, chrom_codes, chrom_positions, status = mapper.map_all_hits(tx_codes, tx_positions)
+        columns = [np.array(tx_ids, dtype=object)[query_ix].tolist(), tx_positions[query_ix], alignment_ix,
+                   chrom_ids[chrom_codes].tolist(), chrom_positions]
+    else:
+        query_ix = None
+        if tx_codes is None:
+            chrom_codes, chrom_positions, status = mapper.map_queries(tx_ids, tx_positions)
+        else:
+            chrom_codes, chrom_positions, status = mapper.map_codes(tx_codes, tx_positions)
+        columns = [tx_ids, tx_positions, chrom_ids[chrom_codes].tolist(), chrom_positions]
+    if status_column:
+        columns.append(_STATUS_NAMES[status].tolist())
+    return status, query_ix, format_chunk(*columns)
+
+
+# Transcript mappings of a worker process started by _run_in_pool, set by _init_worker
+_worker_mapper = None
+_worker_chrom_ids = None
+
+
+def _init_worker(mapper=None, shared_table_spec=None, index_fn=None):
+    global _worker_mapper, _worker_chrom_ids
+    if shared_table_spec is not None:
+        mapper = SegmentTable.attach_shared_memory(shared_table_spec)
+    elif index_fn is not None:
+        mapper = SegmentTable.open(index_fn)
+    _worker_mapper = mapper
+    _worker_chrom_ids = _chrom_id_array(mapper.chroms)
+
+
+def _map_chunk_in_worker(chunk, all_hits=False, format_chunk=ResultWriter.format, status_column=False):
+    """Parse, map and format a chunk of queries read by _read_query_blocks, and check their mapping status.
+
+    :return tuple containing the array of the number of output lines with each MappingStatus code, and the formatted
+        output lines
+    :raises KeyError, ValueError: as _check_mapping_status, unless status_column is True, or if a line of the chunk
+        cannot be parsed
+    """
+    tx_ids, tx_positions = _parse_query_block(chunk.decode()) if isinstance(chunk, bytes) else chunk
+    status, query_ix, formatted = _map_and_format_chunk(_worker_mapper, _worker_chrom_ids, tx_ids, tx_positions,
+                                                        all_hits=all_hits, format_chunk=format_chunk,
+                                                        status_column=status_column)
+    status_counts = np.zeros(len(MappingStatus), dtype=np.int64)
+    _check_mapping_status(tx_ids, tx_positions, status, query_ix, status_counts, status_column)
+    return status_counts, formatted
+
+
+def _run_in_pool(mapper, chunks, writer, workers: int, all_hits: bool = False, status_column: bool = False,
+                 status_counts: np.ndarray = None, start_method: str = None):
+    """Parse, map and format chunks of queries in a pool of worker processes and write the results in input order.
+    This process only reads blocks of lines and writes results; at most two chunks per worker are in flight at a
+    time, so memory use stays bounded by the chunk size.
+
+    :param mapper: SegmentTable or TranscriptIndex used to map the queries. The arrays of a SegmentTable are copied
+        to shared memory once, with a hash table of its transcript IDs as stored in binary index files, and workers
+        attach to them without copying, or memory-map the same binary index file if the table was opened from one.
+        Workers thus never look up transcript IDs in the dict of this process, which would copy the pages of the
+        objects it refers to into every forked worker as their reference counts change. A TranscriptIndex is handed
+        to workers when they start; where available, workers are forked so that they share its memory copy-on-write
+        instead of unpickling a copy, although the pages of the records they read are copied into each of them
+    :param chunks: iterable of chunks of queries returned by _read_query_blocks
+    :param writer: ResultWriter or ArrowResultWriter the output is written to, formatted by workers
+    :param workers: number of worker processes
+    :param all_hits, status_column: as for run()
+    :param status_counts: optional array of the number of output lines with each MappingStatus code, added to
+    :param start_method: multiprocessing start method of the workers, by default 'fork' where available
+    """
+    import multiprocessing     # imported here, as importing it slows down startup of single-process runs
+    if start_method is None and 'fork' in multiprocessing.get_all_start_methods():
+        start_method = 'fork'
+    shared_blocks = []
+    if isinstance(mapper, SegmentTable) and mapper.path is not None:
+        initargs = (None, None, mapper.path)
+    elif isinstance(mapper, SegmentTable):
+        shared_blocks, shared_table_spec = mapper.to_shared_memory()
+        initargs = (None, shared_table_spec)
+    else:
+        initargs = (mapper,)
+
+    context = multiprocessing.get_context(start_method)
+    try:
+        with context.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+            _collect_in_order(pool, chunks, writer, workers, all_hits=all_hits, status_column=status_column,
+                              status_counts=status_counts)
+    finally:
+        for block in shared_blocks:
+            block.close()
+            block.unlink()
+
+
+def _collect_in_order(pool, chunks, writer, workers: int, all_hits: bool = False, status_column: bool = False,
+                      status_counts: np.ndarray = None):
+    """Submit chunks of queries to pool, keeping at most two chunks per worker in flight, and write their results in
+    submission order"""
+    in_flight = collections.deque()
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is not None:
+            in_flight.append(pool.apply_async(_map_chunk_in_worker, (chunk, all_hits, writer.format, status_column)))
+        # Collect chunks in submission order once the window is full, and all remaining ones at the end
+        while in_flight and (chunk is None or len(in_flight) >= 2 * workers):
+            chunk_status_counts, formatted = in_flight.popleft().get()
+            if status_counts is not None:
+                status_counts += chunk_status_counts
+            writer.write_formatted(formatted)
+
+
+def _open_text(fn, newline=None, binary=False):
+    """Open text file for reading, decompressing it while reading if it starts with the gzip magic bytes, as gzip and
+    BGZF files do, whatever its name. If binary is True, its lines are read as bytes, without decoding them."""
+    with open(fn, 'rb') as f:
+        is_compressed = f.read(len(_GZIP_MAGIC)) == _GZIP_MAGIC
+    if binary:
+        return gzip.open(fn, 'rb') if is_compressed else open(fn, 'rb')
+    return gzip.open(fn, 'rt', newline=newline) if is_compressed else open(fn, 'r', newline=newline)
+
+
+def _open_output(output_fn, compress=False, compress_threads=None):
+    """Open output file for writing binary data, as a BGZFWriter if compress is True"""
+    return BGZFWriter(output_fn, compress_threads) if compress else open(output_fn, 'wb')
+
+
+def _columnar_format(fn):
+    """Return 'parquet' or 'arrow' if fn starts with the magic bytes of a Parquet or Arrow IPC file, and None
+    otherwise"""
+    with open(fn, 'rb') as f:
+        magic = f.read(len(_ARROW_MAGIC))
+    if magic.startswith(_PARQUET_MAGIC):
+        return 'parquet'
+    return 'arrow' if magic == _ARROW_MAGIC else None
+
+
+def _read_columnar_batches(fn, chunk_size: int, n_columns: int):
+    """Read Parquet or Arrow IPC file in record batches of at most chunk_size rows, holding only its first n_columns
+    columns (or all of them, if it has fewer). Other columns are not read from a Parquet file, and Arrow IPC files are
+    memory-mapped. pyarrow is only imported when this is called.
+
+    :return generator of pyarrow RecordBatches
+    """
+    import pyarrow     # imported here, as it is an optional dependency only needed for Parquet and Arrow files
+    if chunk_size < 1:
+        raise ValueError(f"Chunk size must be at least 1 (chunk_size = {chunk_size})")
+    if _columnar_format(fn) == 'parquet':
+        import pyarrow.parquet
+        parquet_file = pyarrow.parquet.ParquetFile(fn)
+        yield from parquet_file.iter_batches(batch_size=chunk_size, columns=parquet_file.schema_arrow.names[:n_columns])
+        return
+
+    with pyarrow.memory_map(fn) as source:
+        reader = pyarrow.ipc.open_file(source)
+        for batch_ix in range(reader.num_record_batches):
+            batch = reader.get_batch(batch_ix)
+            batch = batch.select(range(min(n_columns, batch.num_columns)))
+            for start in range(0, batch.num_rows, chunk_size):
+                yield batch.slice(start, chunk_size)
+
+
+def _columnar_to_list(column) -> list:
+    """Return the values of a pyarrow string column as list of strings, converting other types to strings
+
+    :raises ValueError: if the column has null values
+    """
+    if column.null_count:
+        raise ValueError(f"Unexpected null values in input column of type {column.type}")
+    if column.type not in ('string', 'large_string'):
+        column = column.cast('string')
+    return column.to_pylist()
+
+
+def _read_query_file(queries_fn, chunk_size: int, n_columns: int = 2):
+    """Read queries file in chunks of at most chunk_size queries, as _read_query_chunks does, from a tab-delimited text
+    file, which may be compressed, or from the first n_columns columns of a Parquet or Arrow IPC file.
+
+    :return generator of tuples containing list of transcript (or chromosome) IDs and an int64 array for each further
+        column
+    :raises ValueError: if a query does not contain n_columns values, or a coordinate is not an integer, or does not
+        fit in 64-bit signed integers
+    """
+    if _columnar_format(queries_fn) is None:
+        with _open_text(queries_fn) as queries_file:
+            yield from _read_query_chunks(queries_file, chunk_size, n_columns)
+        return
+
+    import pyarrow.types     # imported here, as it is an optional dependency only needed for Parquet and Arrow files
+    for batch in _read_columnar_batches(queries_fn, chunk_size, n_columns):
+        if batch.num_columns != n_columns:
+            raise ValueError(f"Error parsing query file, expecting {n_columns} columns, found {batch.num_columns}")
+        coordinates = []
+        for column in batch.columns[1:]:
+            if column.null_count or not pyarrow.types.is_integer(column.type):
+                raise ValueError(f"Expected integer coordinates in query file, found column of type {column.type}")
+            values = column.to_numpy()
+            # Only uint64 values can exceed the int64 range
+            if values.dtype == np.uint64 and len(values) and values.max() > np.iinfo(np.int64).max:
+                raise ValueError(f"Coordinate out of range in query file (coordinate = {values.max()})")
+            coordinates.append(values.astype(np.int64))
+        yield (_columnar_to_list(batch.column(0)),) + tuple(coordinates)
+
+
+def _read_query_chunks(queries_file, chunk_size: int, n_columns: int = 2):
+    """Read queries file in chunks of at most chunk_size lines, splitting each chunk in bulk rather than line by line.
+
+    :param queries_file: open queries file, with columns [tx_id, tx_pos] and no header, or more integer columns after
+        tx_id if n_columns > 2, e.g. [tx_id, tx_start, tx_end]
+    :param chunk_size: maximum number of lines per chunk
+    :param n_columns: number of columns in each line
+    :return generator of tuples containing list of transcript IDs and an int64 array for each further column
+    :raises ValueError: if a line does not contain n_columns values, or a coordinate is not an integer
+    """
+    if chunk_size < 1:
+        raise ValueError(f"Chunk size must be at least 1 (chunk_size = {chunk_size})")
+    while True:
+        lines = list(itertools.islice(queries_file, chunk_size))
+        if not lines:
+            return
+
+        yield _parse_query_block(''.join(lines), n_columns)
+
+
+def _read_query_blocks(queries_fn, chunk_size: int):
+    """Read queries file in chunks of about chunk_size queries for _map_chunk_in_worker to parse, so that the reading
+    process does not split lines. Chunks of a text file, which may be compressed, are bytes objects holding whole
+    lines: the first chunk_size lines, and then blocks of as many bytes, cut after their last line break. Chunks of a
+    Parquet or Arrow IPC file are parsed as _read_query_file does.
+
+    :return generator of bytes objects, or of tuples containing list of transcript IDs and array of coordinates
+    """
+    if _columnar_format(queries_fn) is not None:
+        yield from _read_query_file(queries_fn, chunk_size)
+        return
+    if chunk_size < 1:
+        raise ValueError(f"Chunk size must be at least 1 (chunk_size = {chunk_size})")
+
+    with _open_text(queries_fn, binary=True) as queries_file:
+        block = b''.join(itertools.islice(queries_file, chunk_size))
+        block_size = len(block)
+        remainder = b''
+        while block:
+            block = remainder + block
+            cut = block.rfind(b'\n') + 1
+            if cut:
+                yield block[:cut]
+            remainder = block[cut:]
+            block = queries_file.read(block_size)
+        if remainder:
+            yield remainder
+
+
+def _parse_query_block(block: str, n_columns: int = 2):
+    """Parse block of whole lines of a queries file, splitting them in bulk rather than line by line.
+
+    :param block: lines with columns [tx_id, tx_pos], or more integer columns after tx_id if n_columns > 2
+    :param n_columns: number of columns in each line
+    :return tuple containing list of transcript IDs and an int64 array for each further column
+    :raises ValueError: if a line does not contain n_columns values, or a coordinate is not an integer
+    """
+    # Split the block in bulk with a marker token at the start of each line. The block is well-formed if the tokens
+    # are groups of a marker and n_columns fields, so that missing fields of a line are not made up by another line
+    lines = block[:-1] if block.endswith('\n') else block
+    n_lines = lines.count('\n') + 1
+    tokens = (_QUERY_LINE_MARKER + ' ' + lines.replace('\n', '\n' + _QUERY_LINE_MARKER + ' ')).split()
+    if len(tokens) != (n_columns + 1) * n_lines or tokens[::n_columns + 1].count(_QUERY_LINE_MARKER) != n_lines or \
+            tokens.count(_QUERY_LINE_MARKER) != n_lines:
+        # Find the offending line, or split line by line if a line holds a marker token itself
+        for line in lines.split('\n'):
+            if len(line.split()) != n_columns:
+                print(f"Error parsing query file, expecting {n_columns} values, check formatting in line: {line}")
+                raise ValueError(f"Expected {n_columns} values in query line, found {len(line.split())}")
+        tokens = [token for line in lines.split('\n') for token in [_QUERY_LINE_MARKER] + line.split()]
+
+    return (tokens[1::n_columns + 1],) + tuple(np.array(tokens[column + 1::n_columns + 1]).astype(np.int64)
+                                               for column in range(1, n_columns))
+
+
+def _chrom_id_array(chroms) -> np.ndarray:
+    """Return object array of chromosome IDs indexed by chromosome code, with _UNMAPPED_CHROM_ID at the end, so that
+    chromosome code -1 of unknown transcripts picks it"""
+    return np.array(list(chroms) + [_UNMAPPED_CHROM_ID], dtype=object)
+
+
+def _check_mapping_status(tx_ids, tx_positions, status, query_ix=None, status_counts=None, allow_unmapped=False):
+    """Count the MappingStatus codes of a chunk of queries, and raise on the first query in the chunk that could not be
+    mapped unless allow_unmapped is True. Statuses are counted in bulk rather than reported query by query.
+
+    :param query_ix: optional array holding, for each entry of status, the index of its query in tx_ids and
+        tx_positions, if there is not one status per query
+    :param status_counts: optional array of the number of queries with each MappingStatus code, added to
+    :raises KeyError: if a query transcript was not found in the transcript mappings
+    :raises ValueError: if a query transcript coordinate is out-of-bounds
+    """
+    if status_counts is not None:
+        status_counts += np.bincount(status, minlength=len(status_counts))
+    if allow_unmapped:
+        return
+    if query_ix is None:
+        query_ix = np.arange(len(status))
+    unmapped = np.flatnonzero((status == MappingStatus.UNKNOWN_TX) | (status == MappingStatus.OUT_OF_BOUNDS))
+    if len(unmapped):
+        ix = query_ix[unmapped[0]]
+        if status[unmapped[0]] == MappingStatus.UNKNOWN_TX:
+            print(f"Query transcript ID ({tx_ids[ix]}) not found in transcript mappings")
+            raise KeyError(tx_ids[ix])
+        raise ValueError(f"Transcript position out of bounds (tx_id = {tx_ids[ix]}, tx_pos = {tx_positions[ix]})")
+
+
+def _report_status_counts(status_counts, unit='queries'):
+    """Print the number of queries (or other output lines) with each MappingStatus code that occurred"""
+    counts = ', '.join(f'{status.name} = {count}' for status, count in zip(MappingStatus, status_counts.tolist())
+                       if count)
+    print(f'Mapping status of {status_counts.sum()} {unit}: {counts or "none"}')
+
+
+def get_coordinate_mapping(tx_id: str, tx_pos: int, transcripts: TranscriptIndex) -> (str, int):
+    """Find query transcript in transcripts and return its mapping to genomic coordinates.
+    Transcripts with more than one alignment are mapped using their first (primary) alignment.
 
     :param tx_id: string containing transcript ID, example 'TR1'
     :param tx_pos: integer containing transcript coordinate (0-based)
-    :param df_transcripts: DataFrame containing mappings of all transcripts
+    :param transcripts: TranscriptIndex containing mappings of all transcripts
     :return tuple containing chromosome ID and integer indicating chromosome coordinate (0-based)
-    :raises KeyError: if query transcript not found in df_transcripts
+    :raises KeyError: if query transcript not found in transcripts
     """
 
     try:
-        tx_mapping = df_transcripts.loc[tx_id]
+        tx_mapping = transcripts[tx_id]
     except KeyError:
-        print(f"Query transcript ID ({tx_id}) not found in transcript mappings DataFrame")
+        print(f"Query transcript ID ({tx_id}) not found in transcript mappings")
         raise
 
-    cigar = CIGARString(tx_mapping.CIGAR_str)
-    chrom_pos = cigar.map_coordinate(tx_pos, tx_mapping.mapping_start_pos)
-    return tx_mapping.chrom_id, chrom_pos
+    chrom_pos = tx_mapping.cigar.map_coordinate(tx_pos, tx_mapping.mapping_start_pos, tx_mapping.strand)
+    return transcripts.chroms[tx_mapping.chrom_code], chrom_pos
 
 
 def main():
@@ -165,15 +2153,93 @@ def main():
     parser = argparse.ArgumentParser(
         description='Translate transcript coordinates to genomic coordinates.')
     parser.add_argument('--transcripts', '-t', required=True,
-                        help='Path to file containing list of transcripts and their genomic mapping.')
-    parser.add_argument('--queries', '-q', required=True,
+                        help='Path to file containing list of transcripts and their genomic mapping, to a GTF or GFF3 '
+                             'annotation file (.gtf, .gff, .gff3), to a SAM file of transcript alignments (.sam), or '
+                             'to a binary index built with --build-index.')
+    parser.add_argument('--queries', '-q',
                         help='Path to file containing list of queries with transcript coordinates.')
-    parser.add_argument('--output', '-o', required=True,
+    parser.add_argument('--output', '-o',
                         help='Output file containing chromosome mapping coordinates.')
+    parser.add_argument('--build-index', metavar='INDEX',
+                        help='Write the transcript mappings to binary index file INDEX and exit, instead of mapping '
+                             'queries. Pass INDEX as --transcripts in later runs to skip parsing the transcripts.')
+    parser.add_argument('--genome-queries', action='store_true',
+                        help='Queries are genome coordinates [chrom_id, chrom_pos]; output every transcript coordinate '
+                             'aligned to each of them as [chrom_id, chrom_pos, tx_id, tx_pos], searching the first '
+                             'alignment of each transcript.')
+    parser.add_argument('--all-hits', action='store_true',
+                        help='Map each query on every alignment of its transcript, for transcripts listed more than '
+                             'once, and output [tx_id, tx_pos, alignment_ix, chrom_id, chrom_pos] for each of them. '
+                             'With --genome-queries, search every alignment and output [chrom_id, chrom_pos, tx_id, '
+                             'tx_pos, alignment_ix].')
+    parser.add_argument('--intervals', action='store_true',
+                        help='Queries are half-open transcript intervals [tx_id, tx_start, tx_end]; output the genomic '
+                             'blocks of each as [tx_id, tx_start, tx_end, chrom_id, chrom_start, chrom_end].')
+    parser.add_argument('--status-column', action='store_true',
+                        help='Add a status column (OK, IN_INSERTION, OUT_OF_BOUNDS, UNKNOWN_TX) to the output, and '
+                             'output queries that cannot be mapped instead of stopping at the first of them.')
+    parser.add_argument('--verify-index', action='store_true',
+                        help='Check the checksum of a binary index passed as --transcripts before mapping.')
+    parser.add_argument('--min-mapq', type=int, default=0,
+                        help='Skip SAM records with a mapping quality below this, if --transcripts is a SAM file '
+                             '(default: %(default)s).')
+    parser.add_argument('--exclude-flags', type=lambda value: int(value, 0), default=_SAM_EXCLUDE_FLAGS,
+                        help='Skip SAM records with any of these FLAG bits set, if --transcripts is a SAM file '
+                             '(default: 0x%(default)x, i.e. unmapped, secondary, QC-failed and supplementary).')
+    parser.add_argument('--cigar-cache-size', type=int, default=_CIGAR_CACHE_SIZE,
+                        help='Maximum number of distinct parsed CIGAR strings kept in memory while loading '
+                             'transcripts, 0 disables the cache (default: %(default)s).')
+    parser.add_argument('--group-by-tx', action='store_true',
+                        help='Map each chunk of queries transcript by transcript instead of against a flattened table '
+                             'of all transcripts.')
+    parser.add_argument('--output-format', choices=_OUTPUT_FORMATS, default='tsv',
+                        help='Write output as tab-delimited text, or as a Parquet or Arrow IPC file with the same '
+                             'columns; needs pyarrow (default: %(default)s). Parquet and Arrow IPC input files are '
+                             'detected and read whatever this option.')
+    parser.add_argument('--compress', action='store_true',
+                        help='Write output compressed as BGZF, which gzip and htslib tools can read. Compressed input '
+                             'files are detected and decompressed whatever this option.')
+    parser.add_argument('--compress-threads', type=int,
+                        help='Number of threads compressing output with --compress (default: number of CPUs).')
+    parser.add_argument('--write-buffer-size', type=int, default=_WRITE_BUFFER_SIZE,
+                        help='Number of bytes of formatted output collected before each write (default: %(default)s).')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes parsing and mapping chunks of queries in parallel '
+                             '(default: %(default)s).')
+    parser.add_argument('--chunk-size', type=int, default=_QUERY_CHUNK_SIZE,
+                        help='Number of queries read, mapped and written at a time (default: %(default)s).')
 
     args = parser.parse_args()
+    sam_filter = SAMFilter(min_mapq=args.min_mapq, exclude_flags=args.exclude_flags)
+
+    if args.build_index:
+        build_index(transcripts_fn=args.transcripts, index_fn=args.build_index, cigar_cache_size=args.cigar_cache_size,
+                    sam_filter=sam_filter)
+        return 0
+    if args.queries is None or args.output is None:
+        parser.error('the following arguments are required: --queries/-q, --output/-o')
+
+    if args.genome_queries:
+        run_genome_queries(transcripts_fn=args.transcripts, queries_fn=args.queries, output_fn=args.output,
+                           cigar_cache_size=args.cigar_cache_size, chunk_size=args.chunk_size,
+                           write_buffer_size=args.write_buffer_size, verify_index=args.verify_index,
+                           sam_filter=sam_filter, compress=args.compress, compress_threads=args.compress_threads,
+                           output_format=args.output_format, all_hits=args.all_hits)
+        return 0
+    if args.intervals:
+        run_interval_queries(transcripts_fn=args.transcripts, queries_fn=args.queries, output_fn=args.output,
+                             cigar_cache_size=args.cigar_cache_size, chunk_size=args.chunk_size,
+                             write_buffer_size=args.write_buffer_size, verify_index=args.verify_index,
+                             sam_filter=sam_filter, compress=args.compress, compress_threads=args.compress_threads,
+                             output_format=args.output_format, status_column=args.status_column)
+        return 0
 
-    run(transcripts_fn=args.transcripts, queries_fn=args.queries, output_fn=args.output)
+    run(transcripts_fn=args.transcripts, queries_fn=args.queries, output_fn=args.output,
+        cigar_cache_size=args.cigar_cache_size, group_by_tx=args.group_by_tx,
+        chunk_size=args.chunk_size, write_buffer_size=args.write_buffer_size,
+        workers=args.workers, verify_index=args.verify_index, all_hits=args.all_hits, sam_filter=sam_filter,
+        compress=args.compress, compress_threads=args.compress_threads, output_format=args.output_format,
+        status_column=args.status_column)
 
     return 0
 
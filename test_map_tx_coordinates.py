@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+import gzip
+import multiprocessing
+import random
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+import map_tx_coordinates as mtc
+
+
+def random_cigar(rng: random.Random, ops: str = mtc._CIGAR_OPS, max_regions: int = 8) -> str:
+    """ Return a random CIGAR string of all given ops, including zero-length regions, with at least one matched base """
+    regions = [f'{rng.randint(0, 12)}{rng.choice(ops)}' for _ in range(rng.randint(1, max_regions))]
+    regions.insert(rng.randint(0, len(regions)), f'{rng.randint(1, 12)}M')
+    return ''.join(regions)
+
+
+def random_transcripts(seed: int, n_tx: int = 300) -> mtc.TranscriptIndex:
+    """ Return TranscriptIndex of n_tx transcripts with random CIGAR strings, on both strands """
+    rng = random.Random(seed)
+    transcripts = mtc.TranscriptIndex()
+    for tx_ix in range(n_tx):
+        transcripts.add(f'TX{tx_ix}', f'chr{rng.randint(1, 3)}', rng.randint(0, 1000), random_cigar(rng),
+                        rng.choice('+-'))
+    return transcripts
+
+
+def test_map_interval_matches_segment_table():
+    transcripts = random_transcripts(seed=1)
+    table = mtc.SegmentTable(transcripts)
+    rng = random.Random(2)
+    for tx_id, record in transcripts.records():
+        tx_length = record.cigar.tx_length
+        for _ in range(5):
+            tx_start = rng.randrange(tx_length)
+            tx_end = rng.randint(tx_start + 1, tx_length)
+            expected = record.cigar.map_interval(tx_start, tx_end, record.mapping_start_pos, record.strand)
+
+            _, chrom_codes, block_tx_starts, block_tx_ends, chrom_starts, chrom_ends, status = table.map_intervals(
+                table.encode_tx_ids([tx_id]), [tx_start], [tx_end])
+            assert set(chrom_codes.tolist()) == {record.chrom_code}
+            blocks = [mtc.MappedBlock(*block) for block in zip(block_tx_starts.tolist(), block_tx_ends.tolist(),
+                                                                 chrom_starts.tolist(), chrom_ends.tolist(),
+                                                                 status.tolist())]
+            assert blocks == expected, (record.cigar.cigar_str, record.strand, tx_start, tx_end)
+
+
+def test_map_interval_skips_zero_length_regions():
+    blocks = mtc.CIGARString('6M6I5=4M1M0S1X').map_interval(0, 23, 27)
+    assert blocks == [(0, 6, 27, 33, mtc.MappingStatus.OK), (6, 12, 33, 33, mtc.MappingStatus.IN_INSERTION),
+                      (12, 23, 33, 44, mtc.MappingStatus.OK)]
+
+
+def expected_mappings(transcripts: mtc.TranscriptIndex, tx_ids, tx_positions, alignment_ix: int = 0):
+    """ Map queries one by one with CIGARString.map_coordinate_status on the given alignment of their transcripts,
+    returning chromosome codes, genomic coordinates and MappingStatus codes in the form of SegmentTable.map_queries """
+    chrom_codes, chrom_positions, status = [], [], []
+    for tx_id, tx_pos in zip(tx_ids, tx_positions):
+        if tx_id not in transcripts:
+            chrom_codes.append(-1)
+            chrom_positions.append(-1)
+            status.append(mtc.MappingStatus.UNKNOWN_TX)
+            continue
+        record = transcripts.alignments(tx_id)[alignment_ix]
+        chrom_pos, tx_status = record.cigar.map_coordinate_status(tx_pos, record.mapping_start_pos, record.strand)
+        chrom_codes.append(record.chrom_code)
+        chrom_positions.append(chrom_pos)
+        status.append(tx_status)
+    return chrom_codes, chrom_positions, status
+
+
+def write_transcripts_file(transcripts: mtc.TranscriptIndex, transcripts_fn):
+    """ Write the primary alignments of transcripts to a tab-delimited transcripts file """
+    with open(transcripts_fn, 'w') as transcripts_file:
+        for tx_id, record in transcripts.records():
+            transcripts_file.write(f'{tx_id}\t{transcripts.chroms[record.chrom_code]}\t{record.mapping_start_pos}\t'
+                                   f'{record.cigar.cigar_str}\t{record.strand}\n')
+
+
+def random_queries(transcripts: mtc.TranscriptIndex, seed: int, n_queries: int = 20000):
+    """ Return random queries on the transcripts, including out-of-bounds coordinates and unknown transcripts """
+    rng = random.Random(seed)
+    tx_ids = list(transcripts) + ['UNKNOWN']
+    queries_tx_ids = [rng.choice(tx_ids) for _ in range(n_queries)]
+    queries_tx_positions = [rng.randint(-2, transcripts[tx_id].cigar.tx_length + 1) if tx_id in transcripts else 0
+                            for tx_id in queries_tx_ids]
+    return queries_tx_ids, queries_tx_positions
+
+
+def test_segment_table_matches_map_coordinate_status():
+    transcripts = random_transcripts(seed=3)
+    table = mtc.SegmentTable(transcripts)
+    tx_ids, tx_positions = random_queries(transcripts, seed=4)
+    chrom_codes, chrom_positions, status = table.map_queries(tx_ids, tx_positions)
+    assert (chrom_codes.tolist(), chrom_positions.tolist(), status.tolist()) == \
+        expected_mappings(transcripts, tx_ids, tx_positions)
+
+    # Grouping queries by transcript gives the same results
+    chrom_codes, chrom_positions, status = transcripts.map_queries(tx_ids, tx_positions)
+    assert (chrom_codes.tolist(), chrom_positions.tolist(), status.tolist()) == \
+        expected_mappings(transcripts, tx_ids, tx_positions)
+
+
+def test_segment_table_all_hits_matches_map_coordinate_status():
+    transcripts = random_transcripts(seed=5)
+    rng = random.Random(6)
+    for tx_id in list(transcripts)[::3]:
+        transcripts.add(tx_id, 'chrAlt', rng.randint(0, 1000), random_cigar(rng), rng.choice('+-'))
+    table = mtc.SegmentTable(transcripts)
+    tx_ids, tx_positions = random_queries(transcripts, seed=7)
+
+    query_ix, alignment_ix, chrom_codes, chrom_positions, status = table.map_all_hits(
+        table.encode_tx_ids(tx_ids), tx_positions)
+    for ix in range(len(query_ix)):
+        tx_id, tx_pos = tx_ids[query_ix[ix]], tx_positions[query_ix[ix]]
+        expected = expected_mappings(transcripts, [tx_id], [tx_pos], alignment_ix[ix])
+        assert (chrom_codes[ix], chrom_positions[ix], status[ix]) == tuple(values[0] for values in expected)
+    n_alignments = [len(transcripts.alignments(tx_id)) if tx_id in transcripts else 1 for tx_id in tx_ids]
+    assert np.bincount(query_ix, minlength=len(tx_ids)).tolist() == n_alignments
+
+
+def test_saved_index_matches_segment_table(tmp_path):
+    transcripts = random_transcripts(seed=8)
+    mtc.SegmentTable(transcripts).save(tmp_path / 'transcripts.idx')
+    table = mtc.SegmentTable.open(str(tmp_path / 'transcripts.idx'), verify=True)
+    tx_ids, tx_positions = random_queries(transcripts, seed=9)
+    chrom_codes, chrom_positions, status = table.map_queries(tx_ids, tx_positions)
+    assert (chrom_codes.tolist(), chrom_positions.tolist(), status.tolist()) == \
+        expected_mappings(transcripts, tx_ids, tx_positions)
+
+
+def test_genome_interval_index_matches_map_coordinate_status():
+    transcripts = random_transcripts(seed=10)
+    transcripts.add('LONG', 'chr1', 0, '2000M', '+')     # longer than all other blocks, in a length class of its own
+    expected = collections.defaultdict(set)
+    for tx_id, record in transcripts.records():
+        for tx_pos in range(record.cigar.tx_length):
+            chrom_pos, status = record.cigar.map_coordinate_status(tx_pos, record.mapping_start_pos, record.strand)
+            if status == mtc.MappingStatus.OK:
+                expected[transcripts.chroms[record.chrom_code], chrom_pos].add((tx_id, tx_pos))
+
+    intervals = mtc.GenomeIntervalIndex(mtc.SegmentTable(transcripts))
+    chrom_ids = [f'chr{chrom_ix}' for chrom_ix in range(1, 5) for _ in range(-2, 2100)]
+    chrom_positions = [chrom_pos for _ in range(1, 5) for chrom_pos in range(-2, 2100)]
+    query_ix, tx_codes, tx_positions, alignment_ix = intervals.query_many(chrom_ids, chrom_positions)
+    hits = collections.defaultdict(set)
+    for ix, tx_code, tx_pos in zip(query_ix.tolist(), tx_codes.tolist(), tx_positions.tolist()):
+        hits[chrom_ids[ix], chrom_positions[ix]].add((intervals.tx_ids[tx_code], tx_pos))
+    assert hits == expected
+    assert np.all(np.diff(query_ix) >= 0)
+
+
+def test_run_in_pool_matches_single_process(tmp_path):
+    transcripts = random_transcripts(seed=11)
+    write_transcripts_file(transcripts, tmp_path / 'transcripts.txt')
+    tx_ids, tx_positions = random_queries(transcripts, seed=12, n_queries=5000)
+    with open(tmp_path / 'queries.txt', 'w') as queries_file:
+        queries_file.write('\n'.join(f'{tx_id}\t{tx_pos}' for tx_id, tx_pos in zip(tx_ids, tx_positions)))
+
+    for workers in (1, 3):
+        mtc.run(str(tmp_path / 'transcripts.txt'), str(tmp_path / 'queries.txt'),
+                str(tmp_path / f'output_{workers}.txt'), chunk_size=700, workers=workers, status_column=True)
+    assert (tmp_path / 'output_3.txt').read_bytes() == (tmp_path / 'output_1.txt').read_bytes()
+    assert len((tmp_path / 'output_1.txt').read_bytes().splitlines()) == len(tx_ids)
+
+
+def test_malformed_query_lines_raise_whatever_the_chunk_size(tmp_path):
+    # A blank line after a line with two queries, and a short line before a long one, have as many fields in total
+    # as well-formed lines
+    for malformed in ['TR1\t4\tTR2\t0\n\n', 'TR1\t4\nTR2\nTR3\t0\t1\n']:
+        (tmp_path / 'queries.txt').write_text(malformed)
+        for chunk_size in (1, 1000):
+            with pytest.raises(ValueError, match='Expected 2 values in query line'):
+                list(mtc._read_query_file(str(tmp_path / 'queries.txt'), chunk_size))
+            with pytest.raises(ValueError, match='Expected 2 values in query line'):
+                for block in mtc._read_query_blocks(str(tmp_path / 'queries.txt'), chunk_size):
+                    mtc._parse_query_block(block.decode())
+
+
+def loaded_alignments(transcripts: mtc.TranscriptIndex) -> dict:
+    """ Return dict of tx_id -> list of (chrom_id, mapping_start_pos, CIGAR string, strand) of all its alignments """
+    return {tx_id: [(transcripts.chroms[record.chrom_code], record.mapping_start_pos, record.cigar.cigar_str,
+                     record.strand) for record in transcripts.alignments(tx_id)] for tx_id in transcripts}
+
+
+_GTF = ('#!genome-build test\n'
+        'chr1\ttest\ttranscript\t101\t250\t.\t+\t.\tgene_id "G1"; transcript_id "TX1";\n'
+        'chr1\ttest\texon\t201\t250\t.\t+\t.\tgene_id "G1"; transcript_id "TX1";\n'
+        'chr1\ttest\texon\t101\t110\t.\t+\t.\tgene_id "G1"; transcript_id "TX1";\n'
+        'chr1\ttest\texon\t116\t120\t.\t+\t.\tgene_id "G1"; transcript_id "TX1";\n'
+        'chr2\ttest\texon\t11\t30\t.\t-\t.\tgene_id "G2"; transcript_id "TX2";\n'
+        'chr2\ttest\texon\t1\t5\t.\t-\t.\tgene_id "G2"; transcript_id "TX2";\n'
+        '\n')
+
+_GFF3 = ('##gff-version 3\n'
+         'chr1\ttest\tmRNA\t101\t250\t.\t+\t.\tID=transcript:TX1\n'
+         'chr1\ttest\texon\t101\t110\t.\t+\t.\tParent=transcript:TX1,transcript:TX3\n'
+         'chr1\ttest\texon\t116\t120\t.\t+\t.\tID=exon2;Parent=transcript:TX1\n'
+         'chr1\ttest\texon\t131\t140\t.\t+\t.\tParent=transcript:TX3\n'
+         'chr1\ttest\texon\t1001\t1001\t.\t.\t.\tParent=TX4\n'
+         '##FASTA\n'
+         '>chr1\n'
+         'ACGT\n')
+
+
+def test_load_annotation(tmp_path):
+    (tmp_path / 'annotation.gtf').write_text(_GTF)
+    assert loaded_alignments(mtc.TranscriptIndex.load_annotation(str(tmp_path / 'annotation.gtf'))) == {
+        'TX1': [('chr1', 100, '10M5N5M80N50M', '+')], 'TX2': [('chr2', 0, '5M5N20M', '-')]}
+
+    (tmp_path / 'annotation.gff3').write_text(_GFF3)
+    assert loaded_alignments(mtc.TranscriptIndex.load_any(str(tmp_path / 'annotation.gff3'))) == {
+        'TX1': [('chr1', 100, '10M5N5M', '+')], 'TX3': [('chr1', 100, '10M20N10M', '+')],
+        'TX4': [('chr1', 1000, '1M', '+')]}
+
+    (tmp_path / 'empty.gtf').write_text('')
+    assert len(mtc.TranscriptIndex.load_annotation(str(tmp_path / 'empty.gtf'))) == 0
+
+
+@pytest.mark.parametrize('exon, message', [('chr1\ttest\texon\t105\t115\t.\t+\t.\ttranscript_id "TX1";', 'Overlapping'),
+                                           ('chr1\ttest\texon\t301\t310\t.\t-\t.\ttranscript_id "TX1";', 'strands'),
+                                           ('chr3\ttest\texon\t301\t310\t.\t+\t.\ttranscript_id "TX1";', 'chromosomes'),
+                                           ('chr1\ttest\texon\t301\t310\t.\t+\t.\tgene_id "G1";', 'without'),
+                                           ('chr1\ttest\texon\t301\t310', '9 values')])
+def test_load_annotation_raises(tmp_path, exon, message):
+    (tmp_path / 'annotation.gtf').write_text(_GTF + exon + '\n')
+    with pytest.raises(ValueError, match=message):
+        mtc.TranscriptIndex.load_annotation(str(tmp_path / 'annotation.gtf'))
+
+
+_SAM = ('@HD\tVN:1.6\tSO:unsorted\n'
+        '@SQ\tSN:chr1\tLN:10000\n'
+        'TX1\t256\tchr2\t51\t60\t5M5N5M\t*\t0\t0\t*\t*\n'
+        'TX1\t0\tchr1\t101\t60\t10M\t*\t0\t0\tACGTACGTAC\t*\tNM:i:0\tAS:i:10\n'
+        'TX2\t16\tchr1\t201\t60\t3M1I3M\t*\t0\t0\t*\t*\n'
+        'TX3\t4\t*\t0\t0\t*\t*\t0\t0\tACGT\t*\n'
+        'TX4\t0\tchr1\t301\t5\t8M\t*\t0\t0\t*\t*\n'
+        'TX1\t2048\tchr3\t11\t60\t4M6S\t*\t0\t0\t*\t*\n'
+        'TX5\t0\tchr1\t1\t60\t*\t*\t0\t0\t*\t*\n')
+
+
+def test_load_sam(tmp_path):
+    (tmp_path / 'alignments.sam').write_text(_SAM)
+    assert loaded_alignments(mtc.TranscriptIndex.load_any(str(tmp_path / 'alignments.sam'))) == {
+        'TX1': [('chr1', 100, '10M', '+')], 'TX2': [('chr1', 200, '3M1I3M', '-')], 'TX4': [('chr1', 300, '8M', '+')]}
+
+    # Secondary and supplementary records follow the primary one, in the order of the file
+    sam_filter = mtc.SAMFilter(min_mapq=10, exclude_flags=0x4)
+    assert loaded_alignments(mtc.TranscriptIndex.load_sam(str(tmp_path / 'alignments.sam'), sam_filter=sam_filter)) == {
+        'TX1': [('chr1', 100, '10M', '+'), ('chr2', 50, '5M5N5M', '+'), ('chr3', 10, '4M6S', '+')],
+        'TX2': [('chr1', 200, '3M1I3M', '-')]}
+
+
+def test_load_sam_raises_on_truncated_record(tmp_path):
+    (tmp_path / 'alignments.sam').write_text(_SAM + 'TX6\t0\tchr1\t1\t60\t5M\t*\t0\t0\t*\n')
+    with pytest.raises(ValueError, match='expecting at least 11 values'):
+        mtc.TranscriptIndex.load_sam(str(tmp_path / 'alignments.sam'))
+
+
+def test_bgzf_output(tmp_path):
+    transcripts = random_transcripts(seed=13)
+    tx_ids, tx_positions = random_queries(transcripts, seed=14, n_queries=20000)
+    write_transcripts_file(transcripts, tmp_path / 'transcripts.txt')
+    (tmp_path / 'queries.txt').write_text(''.join(f'{tx_id}\t{tx_pos}\n'
+                                                  for tx_id, tx_pos in zip(tx_ids, tx_positions)))
+    for compress in (False, True):
+        mtc.run(str(tmp_path / 'transcripts.txt'), str(tmp_path / 'queries.txt'),
+                str(tmp_path / f'output_{compress}'), compress=compress, compress_threads=2, status_column=True)
+    output = (tmp_path / 'output_False').read_bytes()
+    compressed = (tmp_path / 'output_True').read_bytes()
+    assert gzip.decompress(compressed) == output
+
+    # Walk the BGZF blocks: BSIZE is the block size - 1, and ISIZE the size of the data, at most _BGZF_BLOCK_SIZE
+    offset, block_sizes = 0, []
+    while offset < len(compressed):
+        header = mtc._BGZF_HEADER.unpack_from(compressed, offset)
+        assert header[:4] == (0x1f, 0x8b, 8, 4) and header[7:11] == (6, ord('B'), ord('C'), 2)
+        block = compressed[offset:offset + header[-1] + 1]
+        crc, size = struct.unpack('<II', block[-8:])
+        data = zlib.decompress(block[mtc._BGZF_HEADER.size:-8], -15)
+        assert (len(data), zlib.crc32(data)) == (size, crc) and size <= mtc._BGZF_BLOCK_SIZE
+        block_sizes.append(size)
+        offset += len(block)
+    assert len(block_sizes) > 2 and block_sizes[-1] == 0 and compressed.endswith(mtc._BGZF_EOF)
+    assert sum(block_sizes) == len(output)
+
+
+@pytest.mark.parametrize('group_by_tx', [False, True])
+@pytest.mark.parametrize('start_method', ['fork', 'spawn'])
+def test_run_in_pool_start_methods(tmp_path, group_by_tx, start_method):
+    if start_method not in multiprocessing.get_all_start_methods():
+        pytest.skip(f'{start_method} start method not available')
+    transcripts = random_transcripts(seed=15)
+    mapper = transcripts if group_by_tx else mtc.SegmentTable(transcripts)
+    tx_ids, tx_positions = random_queries(transcripts, seed=16, n_queries=3000)
+    chunks = [(tx_ids[start:start + 500], np.array(tx_positions[start:start + 500]))
+              for start in range(0, len(tx_ids), 500)]
+    chunks[1] = ''.join(f'{tx_id}\t{tx_pos}\n' for tx_id, tx_pos in zip(*chunks[1])).encode()
+    status_counts = np.zeros(len(mtc.MappingStatus), dtype=np.int64)
+    with open(tmp_path / 'output.txt', 'wb') as out_file, mtc.ResultWriter(out_file) as writer:
+        mtc._run_in_pool(mapper, chunks, writer, 2, status_column=True, status_counts=status_counts,
+                         start_method=start_method)
+
+    expected = expected_mappings(transcripts, tx_ids, tx_positions)
+    chrom_ids = mtc._chrom_id_array(transcripts.chroms)
+    assert (tmp_path / 'output.txt').read_bytes() == mtc.ResultWriter.format(
+        tx_ids, np.array(tx_positions), chrom_ids[expected[0]].tolist(), np.array(expected[1]),
+        mtc._STATUS_NAMES[expected[2]].tolist())
+    assert status_counts.tolist() == np.bincount(expected[2], minlength=len(mtc.MappingStatus)).tolist()
+
+
+def test_parquet_round_trip(tmp_path):
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+    transcripts = random_transcripts(seed=17)
+    write_transcripts_file(transcripts, tmp_path / 'transcripts.txt')
+    tx_ids, tx_positions = random_queries(transcripts, seed=18, n_queries=3000)
+    (tmp_path / 'queries.txt').write_text(''.join(f'{tx_id}\t{tx_pos}\n'
+                                                  for tx_id, tx_pos in zip(tx_ids, tx_positions)))
+    pyarrow.parquet.write_table(pyarrow.table({'id': tx_ids, 'pos': pyarrow.array(tx_positions, pyarrow.int16())}),
+                                tmp_path / 'queries.parquet', row_group_size=1000)
+
+    mtc.run(str(tmp_path / 'transcripts.txt'), str(tmp_path / 'queries.txt'), str(tmp_path / 'output.txt'),
+            status_column=True)
+    mtc.run(str(tmp_path / 'transcripts.txt'), str(tmp_path / 'queries.parquet'), str(tmp_path / 'output.parquet'),
+            chunk_size=700, output_format='parquet', status_column=True)
+    output = pyarrow.parquet.read_table(tmp_path / 'output.parquet')
+    assert output.column_names == ['tx_id', 'tx_pos', 'chrom_id', 'chrom_pos', 'status']
+    assert [list(map(str, row.values())) for row in output.to_pylist()] == \
+        [line.split('\t') for line in (tmp_path / 'output.txt').read_text().splitlines()]
+
+
+@pytest.mark.parametrize('pos_type, valid', [('uint8', True), ('uint16', True), ('uint64', True),
+                                             ('uint64_overflow', False), ('float64', False)])
+def test_columnar_query_coordinate_types(tmp_path, pos_type, valid):
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.feather
+    positions = [1, 2, 2 ** 63] if pos_type == 'uint64_overflow' else [1, 2, 200]
+    pos_type = pos_type.split('_')[0]
+    pyarrow.feather.write_feather(pyarrow.table({'id': ['TX1', 'TX2', 'TX3'],
+                                                 'pos': pyarrow.array(positions, getattr(pyarrow, pos_type)())}),
+                                  str(tmp_path / 'queries.arrow'))
+    if valid:
+        [(tx_ids, tx_positions)] = mtc._read_query_file(str(tmp_path / 'queries.arrow'), 10)
+        assert tx_ids == ['TX1', 'TX2', 'TX3'] and tx_positions.dtype == np.int64 and tx_positions.tolist() == positions
+    else:
+        with pytest.raises(ValueError):
+            list(mtc._read_query_file(str(tmp_path / 'queries.arrow'), 10))
+
+
+_STATUS_TRANSCRIPTS = 'TX1\tchr1\t10\t3M2I3M\nTX2\tchr2\t5\t4M\t-\n'
+_STATUS_QUERIES = 'TX1\t0\nTX1\t3\nTX1\t8\nTXX\t0\nTX2\t0\nTX1\t-1\n'
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_status_column(tmp_path, capsys, workers):
+    (tmp_path / 'transcripts.txt').write_text(_STATUS_TRANSCRIPTS)
+    (tmp_path / 'queries.txt').write_text(_STATUS_QUERIES)
+    mtc.run(str(tmp_path / 'transcripts.txt'), str(tmp_path / 'queries.txt'), str(tmp_path / 'output.txt'),
+            chunk_size=2, workers=workers, status_column=True)
+    assert (tmp_path / 'output.txt').read_text() == ('TX1\t0\tchr1\t10\tOK\n'
+                                                     'TX1\t3\tchr1\t13\tIN_INSERTION\n'
+                                                     'TX1\t8\tchr1\t-1\tOUT_OF_BOUNDS\n'
+                                                     'TXX\t0\t*\t-1\tUNKNOWN_TX\n'
+                                                     'TX2\t0\tchr2\t8\tOK\n'
+                                                     'TX1\t-1\tchr1\t-1\tOUT_OF_BOUNDS\n')
+    assert 'Mapping status of 6 queries: OK = 2, IN_INSERTION = 1, OUT_OF_BOUNDS = 2, UNKNOWN_TX = 1\n' in \
+        capsys.readouterr().out
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+@pytest.mark.parametrize('first_unmapped, error', [(2, ValueError), (3, KeyError)])
+def test_unmapped_query_raises(tmp_path, workers, first_unmapped, error):
+    # Without a status column, the first query that cannot be mapped raises, here the out-of-bounds or the unknown one
+    (tmp_path / 'transcripts.txt').write_text(_STATUS_TRANSCRIPTS)
+    query_lines = _STATUS_QUERIES.splitlines(keepends=True)
+    (tmp_path / 'queries.txt').write_text(''.join(query_lines[:2] + query_lines[first_unmapped:]))
+    with pytest.raises(error, match='out of bounds' if error is ValueError else 'TXX'):
+        mtc.run(str(tmp_path / 'transcripts.txt'), str(tmp_path / 'queries.txt'), str(tmp_path / 'output.txt'),
+                chunk_size=2, workers=workers)
+
+
+def test_genome_queries_alignments(tmp_path):
+    # TX1 is aligned twice over chr1:100-110, and its second alignment is only reported with all_hits
+    (tmp_path / 'transcripts.txt').write_text('TX1\tchr1\t100\t10M\nTX2\tchr1\t105\t10M\t-\nTX1\tchr1\t100\t5M\n')
+    (tmp_path / 'queries.txt').write_text('chr1\t102\nchr1\t107\nchr2\t0\n')
+    for all_hits in (False, True):
+        mtc.run_genome_queries(str(tmp_path / 'transcripts.txt'), str(tmp_path / 'queries.txt'),
+                               str(tmp_path / f'output_{all_hits}.txt'), all_hits=all_hits)
+    assert (tmp_path / 'output_False.txt').read_text() == 'chr1\t102\tTX1\t2\nchr1\t107\tTX1\t7\nchr1\t107\tTX2\t7\n'
+    assert (tmp_path / 'output_True.txt').read_text() == ('chr1\t102\tTX1\t2\t0\nchr1\t102\tTX1\t2\t1\n'
+                                                          'chr1\t107\tTX1\t7\t0\nchr1\t107\tTX2\t7\t0\n')
+
+
+def test_map_genome_coordinates_matches_map_coordinate_status():
+    rng = random.Random(19)
+    for _ in range(500):
+        cigar = mtc.CIGARString(random_cigar(rng))
+        mapping_start_pos = rng.randint(0, 100)
+        # Forward-strand genome coordinate of each transcript base; bases in insertions and clips take the next one
+        genome_positions = [cigar.map_coordinate_status(tx_pos, mapping_start_pos)[0]
+                            for tx_pos in range(cigar.tx_length)]
+        chrom_positions = list(range(mapping_start_pos - 2, mapping_start_pos + cigar.genome_span + 2))
+        for strand in '+-':
+            expected = []
+            for chrom_pos in chrom_positions:
+                if not 0 <= chrom_pos - mapping_start_pos < cigar.genome_span:
+                    expected.append((-1, mtc.MappingStatus.OUT_OF_BOUNDS))
+                    continue
+                aligned = [tx_pos for tx_pos in range(cigar.tx_length)
+                           if cigar.map_coordinate_status(tx_pos, mapping_start_pos, strand) ==
+                           (chrom_pos, mtc.MappingStatus.OK)]
+                if aligned:
+                    expected.append((aligned[0], mtc.MappingStatus.OK))
+                else:
+                    # In a deletion or intron: the next transcript base, counting the bases before it on the genome
+                    n_before = sum(genome_pos <= chrom_pos for genome_pos in genome_positions)
+                    expected.append((n_before if strand == '+' else cigar.tx_length - n_before,
+                                     mtc.MappingStatus.IN_DELETION))
+
+            tx_positions, status = cigar.map_genome_coordinates(chrom_positions, mapping_start_pos, strand)
+            assert list(zip(tx_positions.tolist(), status.tolist())) == expected, (cigar.cigar_str, strand)
+            for chrom_pos, (tx_pos, tx_status) in zip(chrom_positions, expected):
+                if tx_status == mtc.MappingStatus.OUT_OF_BOUNDS:
+                    with pytest.raises(ValueError):
+                        cigar.map_genome_coordinate(chrom_pos, mapping_start_pos, strand)
+                else:
+                    assert cigar.map_genome_coordinate(chrom_pos, mapping_start_pos, strand) == (tx_pos, tx_status)